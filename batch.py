@@ -0,0 +1,255 @@
+#!/usr/bin/env python2.7
+"""
+Insert soft hyphens into many books at once.  Books are processed by a pool
+of worker processes, which keep hyphenation patterns loaded between books.
+Hyphenated books are written into output directory, mirroring the input
+directory tree.
+"""
+from __future__ import print_function
+import argparse
+import errno
+import glob
+import multiprocessing
+import os
+import Queue
+import sys
+import traceback
+from timeit import default_timer
+import zipfile
+
+from hyphenator import hyphenated_words, use_word_store
+from main import WorkerPool, WORKER_CHECK_INTERVAL, \
+    add_output_cache_arguments, book_format, find_binaries, process_book
+import output_cache
+from word_store import WordStore
+
+# Peak memory of a worker per byte of parsed text, measured on FB2 books
+MEMORY_PER_TEXT_BYTE = 8
+# Memory of a worker processing a book in stream mode
+STREAM_MEMORY = 64 << 20
+DEFAULT_MAX_MEMORY = 2 << 30
+DEFAULT_STREAM_THRESHOLD = 64 << 20
+
+# Entries of zipped books, which hold their text
+TEXT_EXTENSIONS = {
+    '.fb2.zip': ('.fb2',),
+    '.epub': ('.html', '.htm', '.xhtml'),
+}
+
+def find_books(paths):
+    """
+    Yields (input file, output path relative to output directory) of books
+    in paths.  Every path is a book file, a directory, which is searched
+    recursively, or a glob pattern.  Output paths keep the name of a
+    directory and the tree below the last directory of a pattern without
+    wildcards.
+    """
+    for path in paths:
+        if glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+            # Output tree starts at the last directory without wildcards
+            parts = path.split(os.sep)
+            base = os.sep.join(parts[:next(i for i, part in enumerate(parts)
+                if glob.has_magic(part))])
+        else:
+            matches = [path]
+            base = os.path.dirname(os.path.abspath(path))
+        for match in matches:
+            if os.path.isdir(match):
+                for book in _walk_books(match):
+                    yield book, os.path.relpath(book, base or os.curdir)
+            elif book_format(match):
+                yield match, os.path.relpath(match, base or os.curdir)
+
+def _walk_books(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if book_format(name):
+                yield os.path.join(root, name)
+
+def process_task(task):
+    """
+    Hyphenates a single book in a worker process.  Returns (input file,
+    size in bytes, number of words, error message or None).
+    """
+    input_file, output_file, stream, cache_dir, cache_size = task
+    words = hyphenated_words()
+    try:
+        try:
+            os.makedirs(os.path.dirname(output_file))
+        except OSError as e:
+            # Other workers create the same directories
+            if e.errno != errno.EEXIST:
+                raise
+        process_book(input_file, output_file, stream,
+            cache_dir=cache_dir, cache_size=cache_size)
+    except Exception:
+        return input_file, 0, 0, traceback.format_exc()
+    return input_file, os.path.getsize(input_file), \
+        hyphenated_words() - words, None
+
+def estimate_text_size(input_file):
+    """
+    Returns approximate size in bytes of the text of book input_file, which
+    has to be parsed, so images and other binaries are excluded.
+    """
+    ext = book_format(input_file)
+    try:
+        if ext == '.fb2':
+            return os.path.getsize(input_file) - sum(end - start
+                for start, end in find_binaries(input_file))
+        with zipfile.ZipFile(input_file) as archive:
+            return sum(info.file_size for info in archive.infolist()
+                if info.filename.lower().endswith(TEXT_EXTENSIONS[ext]))
+    except Exception:
+        # The book fails later in a worker with a proper error message
+        return os.path.getsize(input_file)
+
+def schedule(books, output_dir, stream=False,
+        stream_threshold=DEFAULT_STREAM_THRESHOLD):
+    """
+    Returns list of (estimated memory, (input file, output file, stream
+    mode)) of books, the biggest books first.  FB2 books with more than
+    stream_threshold bytes of text are processed in stream mode.
+    """
+    jobs = []
+    for input_file, path in books:
+        text_size = estimate_text_size(input_file)
+        book_stream = stream or (book_format(input_file) != '.epub' and
+            text_size > stream_threshold)
+        memory = STREAM_MEMORY if book_stream else \
+            text_size * MEMORY_PER_TEXT_BYTE
+        jobs.append((text_size, memory,
+            (input_file, os.path.join(output_dir, path), book_stream)))
+    # A big book started last keeps a single worker busy after all others
+    jobs.sort(key=lambda job: job[0], reverse=True)
+    return [(memory, task) for _, memory, task in jobs]
+
+def _next_job(jobs, free_memory, idle):
+    """
+    Pops the biggest job, if it fits into free_memory.  Smaller jobs don't
+    overtake it, or the biggest books would be left to run last.
+    """
+    memory, _ = jobs[0]
+    # Too big book still runs, but alone
+    if memory <= free_memory or idle:
+        return jobs.pop(0)
+    return None
+
+def process_books(books, output_dir, jobs, stream=False, langs=('ru',),
+        max_memory=DEFAULT_MAX_MEMORY,
+        stream_threshold=DEFAULT_STREAM_THRESHOLD, cache_dir=None,
+        cache_size=output_cache.DEFAULT_MAX_SIZE):
+    """
+    Hyphenates books, (input file, relative output path) pairs, into
+    output_dir by jobs workers.  A failed book doesn't stop the others.
+    Books are started the biggest first, as long as their estimated memory
+    use fits into max_memory bytes.  cache_dir and cache_size are passed
+    to main.process_book.  Returns tuple of numbers of processed
+    and failed books, total size of processed books in bytes and total
+    number of words.
+    """
+    queue = schedule(books, output_dir, stream, stream_threshold)
+    pool = WorkerPool(jobs, langs)
+    done = Queue.Queue()
+    # Results of running jobs with their estimated memory and input files
+    running = {}
+    used_memory = 0
+    processed = failed = size = words = 0
+    lost = False
+    try:
+        while queue or running:
+            while queue and len(running) < jobs:
+                job = _next_job(queue, max_memory - used_memory,
+                    not running)
+                if job is None:
+                    break
+                memory, task = job
+                used_memory += memory
+                result = pool.apply_tracked(process_task,
+                    (task + (cache_dir, cache_size),), callback=done.put)
+                running[result] = memory, task[0]
+            try:
+                done.get(timeout=WORKER_CHECK_INTERVAL)
+            except Queue.Empty:
+                pass
+            for result in [result for result in running
+                    if pool.lost(result) or result.ready()]:
+                memory, input_file = running.pop(result)
+                used_memory -= memory
+                if result.ready():
+                    _, book_size, book_words, error = result.get()
+                else:
+                    # The book is never finished, others go on
+                    lost = True
+                    error = 'Worker process died, e.g. for lack of memory'
+                if error:
+                    failed += 1
+                    print('ERROR - %s\n%s' % (input_file, error))
+                else:
+                    processed += 1
+                    size += book_size
+                    words += book_words
+                    print('Done %s' % input_file)
+            sys.stdout.flush()
+    finally:
+        # Pool waits for lost jobs forever on join after close
+        if lost or running:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+    return processed, failed, size, words
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        epilog='FB2 (also zipped) and ePub formats are supported.')
+    parser.add_argument('paths', nargs='+', metavar='path',
+        help='book file, directory or glob pattern')
+    parser.add_argument('-o', '--output-dir', required=True,
+        help='directory for hyphenated books')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+        help='number of worker processes, 0 means one per CPU (default: 0)')
+    parser.add_argument('--stream', action='store_true',
+        help='process FB2 element by element, memory use is constant')
+    parser.add_argument('--max-memory', type=int,
+        default=DEFAULT_MAX_MEMORY >> 20,
+        help='estimated memory in MB used by all workers at once, books '
+        'are started when they fit (default: %(default)s)')
+    parser.add_argument('--stream-threshold', type=int,
+        default=DEFAULT_STREAM_THRESHOLD >> 20,
+        help='FB2 books with more MB of text are processed in stream '
+        'mode (default: %(default)s)')
+    parser.add_argument('--languages', default='ru',
+        help='comma separated languages, which patterns are loaded by '
+        'workers in advance (default: %(default)s)')
+    parser.add_argument('--word-store', metavar='FILE',
+        help='SQLite database of hyphenated words shared between runs')
+    add_output_cache_arguments(parser)
+    args = parser.parse_args()
+
+    books = list(find_books(args.paths))
+    if not books:
+        print('No ePub or FB2 books found')
+        sys.exit(1)
+    inputs = {}
+    for input_file, output in books:
+        key = os.path.normcase(output)
+        if key in inputs:
+            parser.error('%s and %s would be written to the same %s' % (
+                inputs[key], input_file, output))
+        inputs[key] = input_file
+    if args.word_store:
+        use_word_store(WordStore(args.word_store))
+    start = default_timer()
+    processed, failed, size, words = process_books(books, args.output_dir,
+        args.jobs or multiprocessing.cpu_count(), args.stream,
+        args.languages.split(','), args.max_memory << 20,
+        args.stream_threshold << 20, args.output_cache,
+        args.output_cache_size << 20)
+    elapsed = default_timer() - start
+    print('%d books processed, %d failed in %.1f s: %.2f books/s, '
+        '%.2f MB/s, %.0f words/s' % (processed, failed, elapsed,
+        processed / elapsed, size / elapsed / (1 << 20), words / elapsed))
+    sys.exit(1 if failed else 0)
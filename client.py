@@ -0,0 +1,71 @@
+#!/usr/bin/env python2.7
+"""
+Insert soft hyphens using hyphenation server (see server.py).  Books are
+given as input and output files like for main.py, otherwise FB2 or XHTML
+document is read from standard input and written to standard output.
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+DEFAULT_SOCKET = os.path.join(os.environ.get('XDG_RUNTIME_DIR') or
+    tempfile.gettempdir(), 'kindle-hyphens.sock')
+
+MAX_HEADER_SIZE = 1 << 16
+
+class ServerError(Exception):
+    pass
+
+def request(header, payload=b'', path=DEFAULT_SOCKET):
+    """
+    Sends job request to server listening on path and returns payload of
+    the reply.  Raises ServerError if the job failed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        f = sock.makefile('rwb')
+        f.write(json.dumps(dict(header, length=len(payload))) + '\n')
+        f.write(payload)
+        f.flush()
+        reply = json.loads(f.readline(MAX_HEADER_SIZE) or 'null')
+        if not reply:
+            raise ServerError('Connection closed by server')
+        if reply['status'] != 'ok':
+            raise ServerError(reply['message'])
+        return f.read(reply['length'])
+    finally:
+        sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('input_file', nargs='?')
+    parser.add_argument('output_file', nargs='?')
+    parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET,
+        help='path of server Unix socket (default: %(default)s)')
+    parser.add_argument('--stream', action='store_true',
+        help='process FB2 element by element, memory use is constant')
+    parser.add_argument('--format', choices=('fb2', 'xhtml'), default='fb2',
+        help='format of standard input document (default: %(default)s)')
+    parser.add_argument('--lang', help='language of XHTML document')
+    args = parser.parse_args()
+    if bool(args.input_file) != bool(args.output_file):
+        parser.error('both input and output files are required')
+
+    try:
+        if args.input_file:
+            # Server has its own working directory
+            request({'job': 'files',
+                'input': os.path.abspath(args.input_file),
+                'output': os.path.abspath(args.output_file),
+                'stream': args.stream}, path=args.socket)
+        else:
+            sys.stdout.write(request({'job': args.format, 'lang': args.lang},
+                sys.stdin.read(), args.socket))
+    except (ServerError, socket.error) as e:
+        print('ERROR - %s' % e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,388 @@
+#coding=utf-8
+"""
+Pattern matching engines for Hyphenator.
+
+Every engine is built from the nested pattern tree produced by
+hyphenator.Patterns._insert_pattern and exposes a single method,
+points(work), which returns the list of Liang points for a '.word.' string.
+All engines produce exactly the same points, they only differ in speed and
+memory use.
+
+state() and from_state() convert engines to and from marshallable values,
+which are stored by pattern_cache.
+
+Run this module with language codes as arguments to compare engines speed.
+"""
+from array import array
+import random
+import sys
+from timeit import default_timer
+
+
+class TreeEngine(object):
+    """Walks the nested dict-of-dicts pattern tree directly."""
+    name = 'tree'
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def state(self):
+        return self.tree
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state)
+
+    def nbytes(self):
+        """Returns approximate memory used by the engine."""
+        size = 0
+        stack = [self.tree]
+        while stack:
+            t = stack.pop()
+            size += sys.getsizeof(t)
+            for c, child in t.items():
+                if c is None:
+                    size += sys.getsizeof(child)
+                else:
+                    stack.append(child)
+        return size
+
+    def points(self, work):
+        points = [0] * (len(work)+1)
+        for i in range(len(work)):
+            t = self.tree
+            for c in work[i:]:
+                if c in t:
+                    t = t[c]
+                    if None in t:
+                        p = t[None]
+                        for j in range(len(p)):
+                            points[i+j] = max(points[i+j], p[j])
+                else:
+                    break
+        return points
+
+
+class ArrayEngine(object):
+    """
+    Compiled trie stored in a handful of flat integer arrays.
+
+    Pattern characters are numbered densely (see self.symbols) and nodes are
+    numbered breadth first, root is 0.  The child of node n for symbol s is
+    transitions[n * width + s], 0 meaning there is no such child.  Points of
+    node n are points_data[points_start[n]:points_start[n+1]], empty for
+    nodes which don't end a pattern.
+    """
+    name = 'array'
+
+    def __init__(self, tree):
+        nodes = [tree]
+        alphabet = set()
+        for t in nodes:
+            for c in _children(t):
+                alphabet.add(c)
+                nodes.append(t[c])
+        self.symbols = dict((c, i) for i, c in enumerate(sorted(alphabet)))
+        self.width = len(alphabet)
+        # Node numbers usually fit into 16 bits, halving the table size
+        self.transitions = array('H' if len(nodes) < 0x10000 else 'l')
+        self.points_start = array('l')
+        self.points_data = array('B')
+        next_id = 1
+        for t in nodes:
+            row = [0] * self.width
+            for c in _children(t):
+                row[self.symbols[c]] = next_id
+                next_id += 1
+            self.transitions.extend(row)
+            self.points_start.append(len(self.points_data))
+            self.points_data.extend(t.get(None, ()))
+        self.points_start.append(len(self.points_data))
+
+    def state(self):
+        return (self.symbols, self.width, self.transitions.typecode,
+            self.transitions.tostring(), self.points_start.tostring(),
+            self.points_data.tostring())
+
+    @classmethod
+    def from_state(cls, state):
+        engine = cls.__new__(cls)
+        (engine.symbols, engine.width, typecode, transitions, points_start,
+            points_data) = state
+        engine.transitions = array(typecode, transitions)
+        engine.points_start = array('l', points_start)
+        engine.points_data = array('B', points_data)
+        return engine
+
+    def nbytes(self):
+        """Returns approximate memory used by the engine."""
+        return _arrays_nbytes(self.transitions, self.points_start,
+            self.points_data) + sys.getsizeof(self.symbols)
+
+    def points(self, work):
+        transitions = self.transitions
+        width = self.width
+        points_start = self.points_start
+        points_data = self.points_data
+
+        get = self.symbols.get
+        symbols = [get(c, -1) for c in work]
+        n = len(symbols)
+        points = [0] * (n+1)
+        for i in range(n):
+            node = 0
+            for k in range(i, n):
+                s = symbols[k]
+                if s < 0:
+                    break
+                node = transitions[node * width + s]
+                if not node:
+                    break
+                start = points_start[node]
+                for m in range(start, points_start[node+1]):
+                    j = i + m - start
+                    if points_data[m] > points[j]:
+                        points[j] = points_data[m]
+        return points
+
+
+class AhoCorasickEngine(object):
+    """
+    Aho-Corasick automaton over the pattern trie, scans a word in one pass.
+
+    Nodes are numbered like in ArrayEngine, but transitions are complete:
+    missing children are replaced by the transitions of the failure link, so
+    every character costs exactly one table lookup.  output_link[n] is the
+    nearest node on the failure chain of n which ends a pattern (0 if
+    none), depth[n] is the length of the pattern ending at n.
+    """
+    name = 'aho'
+
+    def __init__(self, tree):
+        nodes = [tree]
+        alphabet = set()
+        for t in nodes:
+            for c in _children(t):
+                alphabet.add(c)
+                nodes.append(t[c])
+        self.symbols = dict((c, i) for i, c in enumerate(sorted(alphabet)))
+        width = self.width = len(alphabet)
+        typecode = 'H' if len(nodes) < 0x10000 else 'l'
+        self.transitions = array(typecode, [0]) * (len(nodes) * width)
+        self.output_link = array(typecode, [0]) * len(nodes)
+        self.depth = array('B', [0]) * len(nodes)
+        self.points_start = array('l')
+        self.points_data = array('B')
+        for t in nodes:
+            self.points_start.append(len(self.points_data))
+            self.points_data.extend(t.get(None, ()))
+        self.points_start.append(len(self.points_data))
+
+        # Breadth first order guarantees failure links point to nodes, which
+        # are already complete.
+        fail = [0] * len(nodes)
+        next_id = 1
+        for node, t in enumerate(nodes):
+            row = node * width
+            if node:
+                fail_row = fail[node] * width
+                self.transitions[row:row + width] = \
+                    self.transitions[fail_row:fail_row + width]
+            for c in _children(t):
+                s = self.symbols[c]
+                child = next_id
+                next_id += 1
+                fail[child] = self.transitions[row + s] if node else 0
+                self.transitions[row + s] = child
+                self.depth[child] = self.depth[node] + 1
+                suffix = fail[child]
+                self.output_link[child] = suffix if self._ends_pattern(suffix) \
+                    else self.output_link[suffix]
+
+    def _ends_pattern(self, node):
+        return self.points_start[node] != self.points_start[node+1]
+
+    def state(self):
+        return (self.symbols, self.width, self.transitions.typecode,
+            self.transitions.tostring(), self.output_link.tostring(),
+            self.depth.tostring(), self.points_start.tostring(),
+            self.points_data.tostring())
+
+    @classmethod
+    def from_state(cls, state):
+        engine = cls.__new__(cls)
+        (engine.symbols, engine.width, typecode, transitions, output_link,
+            depth, points_start, points_data) = state
+        engine.transitions = array(typecode, transitions)
+        engine.output_link = array(typecode, output_link)
+        engine.depth = array('B', depth)
+        engine.points_start = array('l', points_start)
+        engine.points_data = array('B', points_data)
+        return engine
+
+    def nbytes(self):
+        """Returns approximate memory used by the engine."""
+        return _arrays_nbytes(self.transitions, self.output_link, self.depth,
+            self.points_start, self.points_data) + \
+            sys.getsizeof(self.symbols)
+
+    def points(self, work):
+        transitions = self.transitions
+        width = self.width
+        output_link = self.output_link
+        depth = self.depth
+        points_start = self.points_start
+        points_data = self.points_data
+
+        get = self.symbols.get
+        points = [0] * (len(work)+1)
+        node = 0
+        for k, c in enumerate(work):
+            s = get(c, -1)
+            if s < 0:
+                # No pattern contains this character
+                node = 0
+                continue
+            node = transitions[node * width + s]
+            match = node if points_start[node] != points_start[node+1] \
+                else output_link[node]
+            while match:
+                start = points_start[match]
+                offset = k + 1 - depth[match] - start
+                for m in range(start, points_start[match+1]):
+                    if points_data[m] > points[offset + m]:
+                        points[offset + m] = points_data[m]
+                match = output_link[match]
+        return points
+
+
+class HashEngine(object):
+    """
+    Single flat dict keyed by pattern strings, e.g. 'abcd' -> points.
+
+    Prefixes of patterns are stored as well with empty points, so a scan
+    from some offset stops as soon as the substring isn't a prefix of any
+    pattern, just like the tree walk.
+    """
+    name = 'hash'
+
+    def __init__(self, tree):
+        self.patterns = {}
+        self.max_length = 0
+        stack = [(u'', tree)]
+        while stack:
+            prefix, t = stack.pop()
+            if prefix:
+                self.patterns[prefix] = tuple(t.get(None, ()))
+                self.max_length = max(self.max_length, len(prefix))
+            for c in _children(t):
+                stack.append((prefix + c, t[c]))
+
+    def state(self):
+        return self.patterns, self.max_length
+
+    @classmethod
+    def from_state(cls, state):
+        engine = cls.__new__(cls)
+        engine.patterns, engine.max_length = state
+        return engine
+
+    def nbytes(self):
+        """Returns approximate memory used by the engine."""
+        return sys.getsizeof(self.patterns) + sum(sys.getsizeof(k) +
+            sys.getsizeof(v) for k, v in self.patterns.items())
+
+    def points(self, work):
+        get = self.patterns.get
+        n = len(work)
+        points = [0] * (n+1)
+        for i in range(n):
+            for j in range(i + 1, min(n, i + self.max_length) + 1):
+                p = get(work[i:j])
+                if p is None:
+                    break
+                for m, v in enumerate(p, i):
+                    if v > points[m]:
+                        points[m] = v
+        return points
+
+
+def _arrays_nbytes(*arrays):
+    return sum(a.buffer_info()[1] * a.itemsize for a in arrays)
+
+
+def _children(t):
+    """Returns sorted characters of tree node t."""
+    return sorted(c for c in t if c is not None)
+
+
+ENGINES = {
+    'tree': TreeEngine,
+    'array': ArrayEngine,
+    'aho': AhoCorasickEngine,
+    'hash': HashEngine,
+}
+
+# Fastest engine for every shipped language.  'auto' measures all engines
+# on the patterns instead, which costs a second whenever the pattern cache
+# can't be saved.
+DEFAULT_ENGINE = 'aho'
+
+
+def build_engine(name, tree):
+    """
+    Returns engine of given name built from tree.  'auto' builds every
+    engine and returns the fastest one.
+    """
+    if name == 'auto':
+        return fastest_engine(tree)
+    return ENGINES[name](tree)
+
+
+def fastest_engine(tree, words=None):
+    """Returns engine, which finds points of sample words fastest."""
+    words = words or sample_words(tree)
+    timings = [(measure(engine, words), engine)
+        for engine in (cls(tree) for _, cls in sorted(ENGINES.items()))]
+    return min(timings, key=lambda timing: timing[0])[1]
+
+
+def measure(engine, words, repeat=3):
+    """Returns the best time of finding points of all words."""
+    works = [u'.%s.' % w for w in words]
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        for work in works:
+            engine.points(work)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def sample_words(tree, count=2000):
+    """
+    Returns a reproducible list of pseudo words glued from pattern letters,
+    exercising matching about as much as real text does.
+    """
+    fragments = sorted(HashEngine(tree).patterns)
+    fragments = [f for f in fragments if f.isalpha()]
+    rnd = random.Random(0)
+    return [u''.join(rnd.choice(fragments) for _ in range(rnd.randint(1, 4)))
+        for _ in range(count)]
+
+
+if __name__ == '__main__':
+    import sys
+    from hyphenator import Patterns
+
+    for lang in sys.argv[1:] or ['ru', 'uk', 'en', 'de', 'af']:
+        tree = Patterns((lang,), 'tree', cache_dir=None).tree
+        words = sample_words(tree)
+        for name, cls in sorted(ENGINES.items()):
+            start = default_timer()
+            engine = cls(tree)
+            build = default_timer() - start
+            print('%s\t%s\tbuild %6.3f s\tmatch %6.1f us/word' % (lang, name,
+                build, measure(engine, words) * 1e6 / len(words)))
+        print('%s\tauto\t%s' % (lang, fastest_engine(tree, words).name))
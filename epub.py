@@ -0,0 +1,213 @@
+#coding=utf-8
+"""
+ePub container, which is read and written with the standard zipfile module.
+
+EPubContainer mimics the parts of calibre container interface used by
+main.process_epub_file.  Nothing is extracted to disk: documents are read
+from the archive on demand, and a new archive is written directly, where
+unchanged entries (images, fonts, stylesheets) keep their compressed bytes.
+
+Run this module with ePub files as arguments to measure how long it takes
+to hyphenate and write them, with and without copying compressed entries.
+"""
+import copy
+import os
+import posixpath
+import struct
+from urllib import unquote
+import zipfile
+
+from lxml import etree
+
+from fileutil import COPY_BLOCK_SIZE, replacing
+
+MIMETYPE = 'mimetype'
+CONTAINER_XML = 'META-INF/container.xml'
+ENCRYPTION_XML = 'META-INF/encryption.xml'
+
+# Media types of manifest items, which are hyphenated
+HTML_TYPES = frozenset(['application/xhtml+xml', 'text/html'])
+
+# Font obfuscation algorithms, other encryption means DRM
+FONT_OBFUSCATION = frozenset(['http://www.idpf.org/2008/embedding',
+    'http://ns.adobe.com/pdf/enc#RC'])
+
+# Flag of entries, which sizes and CRC follow the data
+_DATA_DESCRIPTOR = 0x08
+# Header ID of ZIP64 extended information extra field
+_ZIP64_EXTRA = 0x0001
+
+class EPubError(Exception):
+    pass
+
+class EPubContainer(object):
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path)
+        # Entries by decoded names, manifest hrefs are resolved against them
+        self.infos = dict((_decode(info.filename), info)
+            for info in self.zip.infolist())
+        # Replaced entry data by name
+        self.changed = {}
+        self.opf_name = self._opf_name()
+        self.opf = etree.fromstring(self.get_raw(self.opf_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.zip.close()
+
+    def _opf_name(self):
+        try:
+            container = etree.fromstring(self.get_raw(CONTAINER_XML))
+        except KeyError:
+            raise EPubError('%s is missing' % CONTAINER_XML)
+        for rootfile in container.iter('{*}rootfile'):
+            if rootfile.get('media-type') in (None,
+                    'application/oebps-package+xml'):
+                return rootfile.get('full-path')
+        raise EPubError('No OPF file in %s' % CONTAINER_XML)
+
+    def is_drm_encrypted(self):
+        if ENCRYPTION_XML not in self.infos:
+            return False
+        encryption = etree.fromstring(self.get_raw(ENCRYPTION_XML))
+        return any(method.get('Algorithm') not in FONT_OBFUSCATION
+            for method in encryption.iter('{*}EncryptionMethod'))
+
+    def get_html_names(self):
+        """Yields names of XHTML documents in spine order, then the rest."""
+        base = posixpath.dirname(self.opf_name)
+        items = {}
+        for item in self.opf.iter('{*}item'):
+            if item.get('media-type') in HTML_TYPES and item.get('href'):
+                # Escapes are UTF-8, unquote of unicode decodes them as Latin-1
+                href = unquote(item.get('href').encode('utf-8'))
+                name = posixpath.normpath(posixpath.join(base,
+                    href.decode('utf-8')))
+                if name in self.infos:
+                    items[item.get('id')] = name
+        for itemref in self.opf.iter('{*}itemref'):
+            name = items.pop(itemref.get('idref'), None)
+            if name:
+                yield name
+        for name in sorted(set(items.values())):
+            yield name
+
+    def get_raw(self, name):
+        if name in self.changed:
+            return self.changed[name]
+        return self.zip.read(self.infos[name])
+
+    def set(self, name, data):
+        self.changed[name] = data
+
+    def write(self, path, raw=True):
+        """
+        Writes archive with replaced entries to path, which may be the
+        input archive itself.  Unchanged entries are copied compressed,
+        unless raw is false.
+        """
+        with replacing(path) as tmp_path, zipfile.ZipFile(tmp_path, 'w',
+                zipfile.ZIP_DEFLATED, allowZip64=True) as output:
+            self._write(output, raw)
+
+    def _write(self, output, raw):
+        # Readers detect ePub by the first entry, which must be stored
+        mimetype = self.infos.get(MIMETYPE)
+        if mimetype:
+            stored = zipfile.ZipInfo(MIMETYPE, mimetype.date_time)
+            stored.external_attr = mimetype.external_attr
+            output.writestr(stored, self.get_raw(MIMETYPE))
+        else:
+            output.writestr(MIMETYPE, 'application/epub+zip',
+                zipfile.ZIP_STORED)
+        for name, info in sorted(self.infos.items(),
+                key=lambda item: item[1].header_offset):
+            if name == MIMETYPE:
+                continue
+            if name in self.changed:
+                output.writestr(_deflated(info), self.changed[name])
+            elif raw:
+                self._copy_raw(info, output)
+            else:
+                output.writestr(_deflated(info), self.zip.read(info))
+
+    def _copy_raw(self, info, output):
+        """Copies compressed data of entry info into output archive as is."""
+        fp = self.zip.fp
+        fp.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader,
+            fp.read(zipfile.sizeFileHeader))
+        fp.seek(header[zipfile._FH_FILENAME_LENGTH] +
+            header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+        copied = copy.copy(info)
+        # Sizes and CRC are known, so they go into the local header
+        copied.flag_bits &= ~_DATA_DESCRIPTOR
+        # zipfile writes its own ZIP64 record when sizes need it
+        copied.extra = _strip_zip64(info.extra)
+        copied.header_offset = output.fp.tell()
+        output.fp.write(copied.FileHeader())
+        remaining = info.compress_size
+        while remaining:
+            block = fp.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                raise EPubError('%s is truncated' % info.filename)
+            output.fp.write(block)
+            remaining -= len(block)
+        output.filelist.append(copied)
+        output.NameToInfo[copied.filename] = copied
+
+def _deflated(info):
+    """Returns new ZipInfo for deflated data of entry info."""
+    deflated = zipfile.ZipInfo(info.filename, info.date_time)
+    deflated.compress_type = zipfile.ZIP_DEFLATED
+    deflated.external_attr = info.external_attr
+    return deflated
+
+def _strip_zip64(extra):
+    records = []
+    while len(extra) >= 4:
+        header_id, length = struct.unpack('<HH', extra[:4])
+        if header_id != _ZIP64_EXTRA:
+            records.append(extra[:4 + length])
+        extra = extra[4 + length:]
+    return b''.join(records)
+
+def _decode(filename):
+    # Names without UTF-8 flag are byte strings, which are UTF-8 in practice
+    if isinstance(filename, bytes):
+        try:
+            return filename.decode('utf-8')
+        except UnicodeDecodeError:
+            return filename.decode('cp437')
+    return filename
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    from timeit import default_timer
+
+    from main import process_epub_file
+
+    def timed(function, *args):
+        start = default_timer()
+        function(*args)
+        return default_timer() - start
+
+    tmp_path = os.path.join(tempfile.gettempdir(), 'epub-benchmark.epub')
+    for path in sys.argv[1:]:
+        size = os.path.getsize(path) / float(1 << 20)
+        with EPubContainer(path) as container:
+            hyphenate = timed(process_epub_file, container)
+            copy_time = timed(container.write, tmp_path)
+            recompress = timed(container.write, tmp_path, False)
+        os.remove(tmp_path)
+        print('%s\t%.1f MB\thyphenate %6.3f s\twrite %6.3f s (%5.0f MB/s)\t'
+            'recompress %6.3f s (%5.0f MB/s)' % (path, size, hyphenate,
+            copy_time, size / copy_time, recompress, size / recompress))
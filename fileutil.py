@@ -0,0 +1,26 @@
+#coding=utf-8
+"""
+File helpers shared by book processing and the caches.
+"""
+from contextlib import contextmanager
+import os
+
+# Size of blocks copied from input to output
+COPY_BLOCK_SIZE = 1 << 20
+
+@contextmanager
+def replacing(path):
+    """
+    Yields temporary path next to path, which replaces path after the block
+    succeeds and is removed otherwise.  So path may be the input file being
+    read, and readers of path never see it half-written.
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        yield tmp_path
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
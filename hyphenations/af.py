@@ -1,3 +1,4 @@
+#coding=utf-8
 # Hyphenation patterns for Afrikaans
 #
 # This work may be distributed and/or modified under the
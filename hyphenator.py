@@ -10,35 +10,175 @@ Not English hyphenation patterns and code changes added by Denis Malinovsky,
 2012-2013.
 """
 
+from collections import OrderedDict
 from importlib import import_module
+from itertools import groupby
 import re
+import sys
+import threading
+import unicodedata
+import weakref
 
-class Hyphenator:
-    def __init__(self, lang):
-        self.tree = {}
-        # Load corresponding hyphenation patterns, using Russian as a fallback
-        try:
-            self._load_language(lang)
-        except ImportError:
-            lang = 'ru'
-            self._load_language(lang)
-        if lang == 'ru':
-            # Russian texts often require English hyphenation as well
-            self._load_language('en')
+from engines import DEFAULT_ENGINE, ENGINES, build_engine
+import pattern_cache
+import word_tables
+
+# Runs of letters.  Slashes inside them split URLs: example.com/-test/-page.html
+WORD_RE = re.compile(r'[^\W\d_]+(?:/[^\W\d_]*)*', re.U)
+
+# Enough for the most frequent words of a book
+DEFAULT_WORD_CACHE_SIZE = 20000
+
+class WordCache(object):
+    """Size-bounded thread-safe LRU cache of word break positions."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns cached value for key or None."""
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert to mark the key as most recently used
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            if len(self.data) > self.capacity:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def nbytes(self):
+        """Returns approximate memory used by cached entries."""
+        with self.lock:
+            return sys.getsizeof(self.data) + sum(sys.getsizeof(k) +
+                sys.getsizeof(v) for k, v in self.data.items())
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.data),
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+# Languages, which words often appear in texts of a language.  Words are
+# matched against patterns of their own script, so languages written in
+# different scripts don't slow each other down.
+LANGUAGE_SETS = {
+    'ru': ('ru', 'en'),
+    'uk': ('uk', 'en'),
+}
+
+# Script of every pattern language, see char_script
+SCRIPTS = {
+    'af': 'LATIN',
+    'de': 'LATIN',
+    'en': 'LATIN',
+    'ru': 'CYRILLIC',
+    'uk': 'CYRILLIC',
+}
+
+_scripts = {}
+
+def char_script(char):
+    """Returns Unicode script of a letter, e.g. 'LATIN'."""
+    script = _scripts.get(char)
+    if script is None:
+        # lxml returns ASCII text as byte strings
+        script = _scripts[char] = unicodedata.name(unicode(char),
+            '').partition(' ')[0]
+    return script
+
+def language_script(lang):
+    """Returns Unicode script of patterns for lang."""
+    script = SCRIPTS.get(lang)
+    if script is None:
+        patterns = import_module('hyphenations.%s' % lang).patterns
+        if isinstance(patterns, bytes):
+            patterns = patterns.decode('utf-8')
+        script = SCRIPTS[lang] = char_script(next(c for c in patterns
+            if c.isalpha()))
+    return script
+
+def normalize_language(lang):
+    """
+    Returns pattern language for language tag lang, like 'en' for 'en-US',
+    or None if there are no patterns for it.
+    """
+    code = (lang or '').strip().lower().replace('_', '-').partition('-')[0]
+    return code if pattern_cache.pattern_file(code) else None
+
+def resolve_languages(lang):
+    """
+    Returns tuple of pattern languages, which are loaded for lang.  lang is
+    a language tag or several ones joined with '+', like 'de+en'.
+    """
+    langs = tuple(OrderedDict.fromkeys(l for l in
+        map(normalize_language, (lang or '').split('+')) if l))
+    # Load corresponding hyphenation patterns, using Russian as a fallback
+    if not langs:
+        langs = ('ru',)
+    if len(langs) == 1:
+        return LANGUAGE_SETS.get(langs[0], langs)
+    return langs
+
+class Patterns(object):
+    """Patterns and exceptions of languages written in the same script."""
+    def __init__(self, langs, engine=DEFAULT_ENGINE,
+            cache_dir=pattern_cache.DEFAULT_CACHE_DIR):
+        self.languages = langs
+        cached = cache_dir and pattern_cache.load(cache_dir, langs, engine)
+        if cached:
+            name, state, self.exceptions, alphabet = cached
+            self.engine = ENGINES[name].from_state(state)
+        else:
+            self.tree = {}
+            self.exceptions = {}
+            self.letters = set()
+            for l in langs:
+                self._load_language(l)
+            self.engine = build_engine(engine, self.tree)
+            alphabet = u''.join(sorted(self.letters))
+            if cache_dir:
+                pattern_cache.save(cache_dir, langs, engine, self.engine.name,
+                    self.engine.state(), self.exceptions, alphabet)
+        # Compiled engines keep their own copy of the patterns
+        self.tree = self.engine.tree if self.engine.name == 'tree' else None
+        # Matches words made of pattern letters only
+        self.alphabet = re.compile(u'[%s]+$' % re.escape(alphabet), re.U)
 
     def _init_patterns(self, patterns, exceptions):
         for pattern in patterns.split():
             self._insert_pattern(pattern)
 
-        self.exceptions = {}
         for ex in exceptions.split():
             # Convert the hyphenated pattern into a point array for use later.
-            self.exceptions[ex.replace('-', '')] = [0] + [ int(h == '-') for h in re.split(r'[\w]', ex, flags=re.U) ]
+            # Exceptions of the first language win.
+            self.exceptions.setdefault(ex.replace('-', ''), [0] + [ int(h == '-') for h in re.split(r'[\w]', ex, flags=re.U) ])
 
     def _insert_pattern(self, pattern):
         # Convert the a pattern like 'a1bc3d4' into a string of chars 'abcd'
         # and a list of points [ 1, 0, 3, 4 ].
         chars = re.sub('[0-9]', '', pattern)
+        self.letters.update(chars.replace('.', ''))
         points = [ int(d or 0) for d in re.split(u'[^0-9]', pattern, flags=re.U) ]
 
         # Insert the pattern into the tree.  Each character finds a dict
@@ -53,59 +193,284 @@ class Hyphenator:
 
     def _load_language(self, lang):
         module = import_module('hyphenations.%s' % lang)
-        self._init_patterns(module.patterns, module.exceptions)
+        # Some modules have byte string patterns, words are unicode
+        self._init_patterns(*(text.decode('utf-8') if isinstance(text, bytes)
+            else text for text in (module.patterns, module.exceptions)))
+
+    def points(self, word):
+        """Returns list of Liang points of a lowercase word."""
+        # If the word is an exception, get the stored points.
+        if word in self.exceptions:
+            return self.exceptions[word]
+        work = '.' + word + '.'
+        points = self.engine.points(work)
+        # No hyphens in the first two chars or the last two.
+        points[1] = points[2] = points[-2] = points[-3] = 0
+        return points
+
+    def break_positions(self, word):
+        """
+        Given a lowercase word, returns a tuple of offsets where the word
+        can be broken.
+        """
+        return _break_positions(word, self.points(word))
+
+class Hyphenator:
+    def __init__(self, lang, engine=DEFAULT_ENGINE,
+            cache_dir=pattern_cache.DEFAULT_CACHE_DIR,
+            word_cache_size=DEFAULT_WORD_CACHE_SIZE, word_store=None,
+            word_table=True):
+        """
+        Loads patterns for lang into given matching engine (see
+        engines.ENGINES, 'auto' measures all and picks the fastest one), one
+        engine per script of its languages (see resolve_languages).
+        Compiled patterns are cached in cache_dir, pass None to always parse
+        pattern modules.
+        Break positions of up to word_cache_size recently used words are
+        memoized, 0 turns the word cache off.  Words missing there are
+        looked up in word_store (see word_store.WordStore), if given.
+        Frequent words are first looked up in the precomputed table of lang
+        (see word_tables) unless word_table is False.
+        """
+        self.word_cache = WordCache(word_cache_size) if word_cache_size \
+            else None
+        self.word_store = word_store
+        # Number of words passed through hyphenate_text
+        self.words = 0
+        langs = self.languages = resolve_languages(lang)
+
+        groups = OrderedDict()
+        for l in langs:
+            groups.setdefault(language_script(l), []).append(l)
+        # Words of other scripts aren't hyphenated
+        self.scripts = OrderedDict((script, get_patterns(tuple(group), engine,
+            cache_dir)) for script, group in groups.items())
+        # Positions in word store are valid for these patterns only
+        self.store_key = '%s:%d:%s' % ('+'.join(langs),
+            pattern_cache.CACHE_VERSION,
+            pattern_cache.patterns_digest(langs)[:16])
+        # Frequent words skip pattern matching
+        self.word_table = (word_table and
+            word_tables.load(langs[0], langs)) or {}
 
     def hyphenate_word(self, word, separator='-'):
         """Returns a word with separators inserted as hyphens."""
-        result = u''
-        buf = u''
-        word += u'$'
-        for c in word:
-            # Split URLs: example.com/-test/-page.html
-            if c.isalpha() or (c == u'/' and buf):
-                buf += c
-            else:
-                if len(buf):
-                    result += separator.join(self._hyphenate_word(buf))
-                buf = ''
-                result += c
-        result = result[:-1]
-        return result
+        return self.hyphenate_text(word, separator)
+
+    def hyphenate_text(self, text, separator='-', words=None):
+        """
+        Returns text with separators inserted as hyphens into every word,
+        all other characters are left untouched.  words is an optional dict
+        of already hyphenated words (see hyphenate_many), it is used and
+        filled instead of hyphenating the same words again.
+        """
+        if words is None:
+            hyphenate = lambda m: self._hyphenate_run(m.group(), separator)
+        else:
+            def hyphenate(match):
+                run = match.group()
+                try:
+                    return words[run]
+                except KeyError:
+                    result = words[run] = self._hyphenate_run(run, separator)
+                    return result
+        text, count = WORD_RE.subn(hyphenate, text)
+        self.words += count
+        return text
+
+    def _hyphenate_run(self, run, separator):
+        if run.replace(u'/', u'').isalpha():
+            return self._hyphenate_letters(run, separator)
+        # \w matches a few characters, which aren't letters, like '²'
+        parts = []
+        for letters, chars in groupby(run, _is_letter):
+            part = u''.join(chars)
+            parts.append(self._hyphenate_letters(part, separator)
+                if letters else part)
+        return u''.join(parts)
+
+    def _hyphenate_letters(self, run, separator):
+        positions = self.hyphen_positions(run)
+        if not positions:
+            return run
+        return separator.join(_split(run, positions))
+
+    def hyphenate_many(self, words, separator='-'):
+        """
+        Returns a dict mapping every distinct word of words to the word with
+        separators inserted as hyphens.  Each distinct word is hyphenated
+        only once.  Words are counted by hyphenate_text using the dict, not
+        here.
+        """
+        words = set(words)
+        if self.word_store is None:
+            return dict((w, self._hyphenate_run(w, separator)) for w in words)
+        # A single query for many words is much faster
+        self.word_store.prefetch(self.store_key, set(w.lower() for w in words
+            if len(w) > 3 and w.lower() not in self.word_table))
+        try:
+            return dict((w, self._hyphenate_run(w, separator)) for w in words)
+        finally:
+            self.word_store.release()
+
+    def hyphen_positions(self, word):
+        """
+        Given a word, returns a tuple of offsets of the possible hyphenation
+        points, e.g. (2, 6) for 'hyphenation'.
+        """
+        # Short words aren't hyphenated.
+        if len(word) <= 3:
+            return ()
+        key = word.lower()
+        hyphenated = self.word_table.get(key)
+        if hyphenated is not None:
+            return word_tables.positions(hyphenated)
+        if self.word_cache is None:
+            return self._stored_positions(key)
+        positions = self.word_cache.get(key)
+        if positions is None:
+            positions = self._stored_positions(key)
+            self.word_cache.put(key, positions)
+        return positions
+
+    def _stored_positions(self, word):
+        """Returns break positions of lowercase word using word store."""
+        if self.word_store is None:
+            return self._break_positions(word)
+        positions = self.word_store.get(self.store_key, word)
+        if positions is None:
+            positions = self._break_positions(word)
+            self.word_store.put(self.store_key, word, positions)
+        return positions
 
     def _hyphenate_word(self, word):
         """ Given a word, returns a list of pieces, broken at the possible
             hyphenation points.
         """
-        # Short words aren't hyphenated.
-        if len(word) <= 3:
-            return [word]
-        # If the word is an exception, get the stored points.
-        if word.lower() in self.exceptions:
-            points = self.exceptions[word.lower()]
+        return _split(word, self.hyphen_positions(word))
+
+    def _break_positions(self, word):
+        """
+        Given a lowercase word, returns a tuple of offsets where the word
+        can be broken.
+        """
+        for patterns in self.scripts.values():
+            if patterns.alphabet.match(word):
+                return patterns.break_positions(word)
+        scripts = set(map(char_script, word))
+        # Patterns never match letters of another script, so points of all
+        # of them are combined for words like 'example.com/пример/page'
+        points = [patterns.points(word) for script, patterns in
+            self.scripts.items() if script in scripts]
+        if not points:
+            return ()
+        return _break_positions(word, map(max, *points) if len(points) > 1
+            else points[0])
+
+_patterns = weakref.WeakValueDictionary()
+_patterns_lock = threading.Lock()
+
+def get_patterns(langs, engine=DEFAULT_ENGINE,
+        cache_dir=pattern_cache.DEFAULT_CACHE_DIR):
+    """
+    Returns Patterns for langs, which are shared by all hyphenators using
+    them, e.g. English patterns of 'en' and 'ru' hyphenators.
+    """
+    key = (langs, engine, cache_dir)
+    with _patterns_lock:
+        patterns = _patterns.get(key)
+        if patterns is None:
+            patterns = _patterns[key] = Patterns(langs, engine, cache_dir)
+        return patterns
+
+_registry = {}
+_registry_lock = threading.Lock()
+_word_store = None
+# Shared hyphenators by requested language tag and engine
+_by_tag = {}
+
+def get_hyphenator(lang, engine=DEFAULT_ENGINE):
+    """
+    Returns Hyphenator for lang shared by the whole process.  Every language
+    set is built only once, later calls reuse the warm instance, so
+    switching languages costs a dict lookup.
+    """
+    hyphenator = _by_tag.get((lang, engine))
+    if hyphenator is not None:
+        return hyphenator
+    key = (resolve_languages(lang), engine)
+    with _registry_lock:
+        hyphenator = _registry.get(key)
+        if hyphenator is None:
+            hyphenator = _registry[key] = Hyphenator(lang, engine,
+                word_store=_word_store)
+        _by_tag[(lang, engine)] = hyphenator
+        return hyphenator
+
+def use_word_store(store):
+    """
+    Makes shared hyphenators look up words in store (see
+    word_store.WordStore), None turns the store off.
+    """
+    global _word_store
+    with _registry_lock:
+        _word_store = store
+        for hyphenator in _registry.values():
+            hyphenator.word_store = store
+
+def evict_hyphenators(lang=None):
+    """
+    Drops shared hyphenators for lang, or all of them when lang is None.
+    Returns number of dropped instances.
+    """
+    with _registry_lock:
+        if lang is None:
+            keys = list(_registry)
         else:
-            work = '.' + word.lower() + '.'
-            points = [0] * (len(work)+1)
-            for i in range(len(work)):
-                t = self.tree
-                for c in work[i:]:
-                    if c in t:
-                        t = t[c]
-                        if None in t:
-                            p = t[None]
-                            for j in range(len(p)):
-                                points[i+j] = max(points[i+j], p[j])
-                    else:
-                        break
-            # No hyphens in the first two chars or the last two.
-            points[1] = points[2] = points[-2] = points[-3] = 0
-
-        # Examine the points to build the pieces list.
-        pieces = ['']
-        for c, p in zip(word, points[2:]):
-            pieces[-1] += c
-            if p % 2 and c != '-':
-                pieces.append('')
-        return pieces
+            langs = resolve_languages(lang)
+            keys = [key for key in _registry if key[0] == langs]
+        for key in keys:
+            del _registry[key]
+        if keys:
+            _by_tag.clear()
+        return len(keys)
+
+def hyphenated_words():
+    """Returns number of words hyphenated by all shared hyphenators."""
+    with _registry_lock:
+        return sum(hyphenator.words for hyphenator in _registry.values())
+
+def memory_report():
+    """Returns list of dicts describing shared hyphenators and their memory."""
+    with _registry_lock:
+        items = sorted(_registry.items())
+    report = []
+    for (langs, engine), hyphenator in items:
+        cache = hyphenator.word_cache
+        report.append({
+            'languages': '+'.join(langs),
+            'engine': '+'.join(patterns.engine.name
+                for patterns in hyphenator.scripts.values()),
+            'engine_bytes': sum(patterns.engine.nbytes()
+                for patterns in hyphenator.scripts.values()),
+            'word_cache_bytes': cache.nbytes() if cache else 0,
+            'word_cache': cache.stats() if cache else None,
+        })
+    return report
+
+def _break_positions(word, points):
+    # Examine the points to find the breaks.
+    return tuple(i + 1 for i, (c, p) in enumerate(zip(word, points[2:]))
+        if p % 2 and c != '-')
+
+def _split(word, positions):
+    """Returns list of word pieces broken at given offsets."""
+    return [word[start:end] for start, end in
+        zip((0,) + positions, positions + (len(word),))]
+
+def _is_letter(char):
+    """Returns whether char belongs to a word hyphenated as a whole."""
+    return char == u'/' or char.isalpha()
 
 if __name__ == '__main__':
     import sys
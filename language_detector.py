@@ -0,0 +1,172 @@
+#!/usr/bin/env python2.7
+#coding=utf-8
+"""
+Statistical detection of text language among languages with hyphenation
+patterns.
+
+Every language has a profile of its most frequent letter trigrams, built
+from its word table (see word_tables).  A text sample is matched against
+profiles of languages written in the dominant script of the sample only,
+and the language with the most probable trigrams wins.  Confidence grows
+with the lead of the winner and falls when the sample has fewer trigrams
+of the winner profile than its language usually has, e.g. for gibberish.
+
+Run this module with --update to rebuild profiles after word tables
+change, or with text files to see their detected languages.
+"""
+from __future__ import print_function
+import argparse
+from collections import Counter
+import io
+import math
+import os
+import re
+
+from fileutil import replacing
+import pattern_cache
+
+PROFILES_FILE = os.path.join(pattern_cache.PATTERNS_DIR, 'profiles.txt')
+
+# Trigrams kept in a profile
+PROFILE_SIZE = 400
+
+# Characters of text enough to tell the shipped languages apart
+DEFAULT_SAMPLE_SIZE = 2048
+
+# Log likelihood lead of the winner, which makes confidence 1 - 1/e
+CERTAINTY_SCALE = 10.0
+
+# Detected languages with lower confidence aren't trusted
+MIN_CONFIDENCE = 0.5
+
+# Words of the sample, trigrams span their boundaries
+_WORD_RE = re.compile(r'[^\W\d_]+', re.U)
+
+_profiles = None
+
+def trigrams(words):
+    """Yields letter trigrams of words, '_' marks word boundaries."""
+    for word in words:
+        word = u'_%s_' % word.lower()
+        for i in range(len(word) - 2):
+            yield word[i:i + 3]
+
+def build_profile(words, size=PROFILE_SIZE):
+    """
+    Returns (share of trigrams of text covered by the profile, list of the
+    most frequent trigrams) of words, which are given the most frequent
+    first.
+    """
+    counts = Counter()
+    for rank, word in enumerate(words, 1):
+        # Frequency of words falls with their rank, like in running text
+        for trigram in trigrams([word]):
+            counts[trigram] += 1.0 / rank
+    profile = counts.most_common(size)
+    return sum(count for _, count in profile) / sum(counts.values()), \
+        [trigram for trigram, _ in profile]
+
+def update_profiles():
+    """Rebuilds profiles of all languages, which have word tables."""
+    import word_tables
+
+    with replacing(PROFILES_FILE) as tmp_path, \
+            io.open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(u'# Built by language_detector.py --update from word tables\n')
+        for lang in pattern_cache.languages():
+            table = word_tables.read(lang)
+            if table:
+                coverage, profile = build_profile(
+                    [word.replace(u'-', u'') for word in table[2]])
+                f.write(u'%s %.3f %s\n' % (lang, coverage,
+                    u' '.join(profile)))
+
+def profiles():
+    """
+    Returns dict mapping languages to (usual share of text trigrams in the
+    profile, dict of profile trigrams and their log probabilities).
+    """
+    global _profiles
+    if _profiles is None:
+        _profiles = {}
+        try:
+            with io.open(PROFILES_FILE, encoding='utf-8') as f:
+                lines = [line.split() for line in f
+                    if not line.startswith(u'#')]
+        except (IOError, OSError):
+            lines = []
+        for fields in lines:
+            lang, coverage, profile = fields[0], float(fields[1]), fields[2:]
+            # Trigrams are sorted by frequency, which falls like in Zipf's law
+            total = sum(1.0 / rank for rank in range(1, len(profile) + 1))
+            _profiles[lang] = coverage, dict((trigram,
+                math.log(1.0 / rank / total))
+                for rank, trigram in enumerate(profile, 1))
+    return _profiles
+
+def detect(text):
+    """
+    Returns (language, confidence) of text, confidence is between 0 and 1.
+    Language is None if text has no letters of any known language.
+    """
+    from hyphenator import char_script, language_script
+
+    words = _WORD_RE.findall(text)
+    letters = Counter()
+    for word in words:
+        letters[char_script(word[0])] += len(word)
+    if not letters:
+        return None, 0.0
+    script, script_letters = letters.most_common(1)[0]
+    candidates = dict((lang, profile) for lang, (_, profile)
+        in profiles().items() if language_script(lang) == script)
+    if not candidates:
+        return None, 0.0
+    # Unknown trigrams are less probable than any known one
+    floor = min(min(profile.values()) for profile in candidates.values()) - 1
+    scores = dict.fromkeys(candidates, 0.0)
+    found = dict.fromkeys(candidates, 0)
+    total = 0
+    for trigram, count in Counter(trigrams(words)).items():
+        total += count
+        for lang, profile in candidates.items():
+            probability = profile.get(trigram)
+            if probability is None:
+                scores[lang] += floor * count
+            else:
+                scores[lang] += probability * count
+                found[lang] += count
+    ranking = sorted(candidates, key=scores.get, reverse=True)
+    lang = ranking[0]
+    # A single language of the script has nothing to lead
+    lead = scores[lang] - scores[ranking[1]] if len(ranking) > 1 \
+        else CERTAINTY_SCALE * found[lang] / total
+    certainty = 1 - math.exp(-lead / CERTAINTY_SCALE)
+    fit = min(1.0, float(found[lang]) / total / profiles()[lang][0])
+    confidence = certainty * fit * script_letters / sum(letters.values())
+    return lang, confidence
+
+if __name__ == '__main__':
+    import sys
+    from timeit import default_timer
+
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', metavar='file')
+    parser.add_argument('-s', '--sample-size', type=int,
+        default=DEFAULT_SAMPLE_SIZE,
+        help='characters of every file used (default: %(default)s)')
+    parser.add_argument('--update', action='store_true',
+        help='rebuild language profiles from word tables')
+    args = parser.parse_args()
+    if args.update:
+        update_profiles()
+        print('Profiles written to %s' % PROFILES_FILE)
+        sys.exit()
+    for path in args.files:
+        with io.open(path, encoding='utf-8', errors='replace') as f:
+            text = f.read(args.sample_size)
+        start = default_timer()
+        lang, confidence = detect(text)
+        print('%s\t%s\t%.2f\t%.1f ms' % (path, lang, confidence,
+            (default_timer() - start) * 1000))
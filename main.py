@@ -5,116 +5,826 @@ Kindle format to enable hyphenation.  Russian and English hyphenation
 is supported.
 """
 from __future__ import print_function
-import codecs
+import argparse
+from binascii import hexlify
+from collections import OrderedDict
+import errno
+from io import BytesIO
+from itertools import count, islice
 from lxml import etree
+import mmap
+import multiprocessing
+from multiprocessing.pool import Pool
+from multiprocessing.queues import SimpleQueue
 import os
+import re
+import shutil
+import signal
 import sys
+import tempfile
+import threading
+import zipfile
 
-from hyphenator import Hyphenator
+from epub import EPubContainer, EPubError
+from fileutil import COPY_BLOCK_SIZE, replacing
+from hyphenator import WORD_RE, get_hyphenator, normalize_language, \
+    use_word_store
+from language_detector import DEFAULT_SAMPLE_SIZE, MIN_CONFIDENCE, detect
+import output_cache
+from word_store import WordStore
 
 SOFT_HYPHEN = u'\u00AD'
 
-def parse_xml(input_file):
+# Characters of text hyphenated by a worker at once in parallel mode
+DEFAULT_CHUNK_SIZE = 200000
+
+def parse_xml(input_file, jobs=1, chunk_size=DEFAULT_CHUNK_SIZE, lang=None):
     dom = etree.parse(input_file, parser=etree.XMLParser(recover=True))
     # Fallback language is Russian ;)
-    lang = detect_language(dom) or 'ru'
-    return process_dom(dom, lang)
-
-def process_dom(dom, lang):
-    hyphenator = Hyphenator(lang)
-    for tag in ('p', 'v', 'text-author', 'div'):
-        for node in dom.xpath("//*[local-name() = '%s']" % tag):
-            insert_hyphens(node, hyphenator)
+    lang = lang or detect_language(dom) or 'ru'
+    if jobs <= 1:
+        return process_dom(dom, lang)
+    with WorkerPool(jobs, [lang]) as pool:
+        return process_dom(dom, lang, pool=pool, chunk_size=chunk_size)
+
+# Elements, which texts are hyphenated together with all their descendants
+HYPHENATED_TAGS = frozenset(['p', 'v', 'text-author', 'div'])
+
+def process_dom(dom, lang, batch=True, pool=None,
+        chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Inserts soft hyphens into text nodes of dom.  Texts are hyphenated in
+    language of their xml:lang or lang attributes (see slot_languages),
+    lang is used for the rest.  In batch mode the vocabulary of the whole
+    document is collected and hyphenated up front, so every distinct word
+    goes through the patterns only once.  If pool (see WorkerPool) is
+    given, texts are sent to its workers in chunks of about chunk_size
+    characters.
+    """
+    root = dom.getroot() if hasattr(dom, 'getroot') else dom
+    slots = list(text_slots(root))
+    if root.xpath('boolean(descendant-or-self::*[@xml:lang or @lang])'):
+        groups = group_slots(slots, slot_languages(slots, lang))
+    else:
+        # The whole document is in lang, nothing to look up
+        groups = [(lang, slots)]
+    for slots_lang, slots in groups:
+        if pool is None:
+            hyphenate_slots(slots, get_hyphenator(slots_lang), batch)
+        else:
+            hyphenate_slots_parallel(slots, slots_lang, pool, chunk_size)
     return dom
 
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+def slot_languages(slots, lang):
+    """
+    Returns list of languages of texts of slots (see text_slots).  Language
+    of an element is given by its xml:lang or lang attribute and is
+    inherited by its descendants, lang is the language of the document.
+    Tags without hyphenation patterns are ignored.  Tail text belongs to
+    the parent element.
+    """
+    known = {None: normalize_language(lang) or lang}
+    langs = []
+    for node, attr in slots:
+        element = node if attr == 'text' else node.getparent()
+        path = []
+        while element not in known:
+            code = normalize_language(element.get(XML_LANG) or
+                element.get('lang'))
+            if code:
+                known[element] = code
+                break
+            path.append(element)
+            element = element.getparent()
+        element_lang = known[element]
+        for element in path:
+            known[element] = element_lang
+        langs.append(element_lang)
+    return langs
+
+def group_slots(slots, langs):
+    """Returns list of (language, slots in it) in order of appearance."""
+    groups = OrderedDict()
+    for slot, lang in zip(slots, langs):
+        groups.setdefault(lang, []).append(slot)
+    return list(groups.items())
+
+def hyphenate_slots(slots, hyphenator, batch=True):
+    """Hyphenates texts of (node, attribute) pairs produced by text_slots."""
+    table = hyphenator.hyphenate_many(collect_words(getattr(node, attr)
+        for node, attr in slots), SOFT_HYPHEN) if batch else None
+    for node, attr in slots:
+        setattr(node, attr, hyphenator.hyphenate_text(getattr(node, attr),
+            SOFT_HYPHEN, table))
+
+def hyphenate_texts(texts, hyphenator, batch=True):
+    """Returns list of hyphenated texts."""
+    table = hyphenator.hyphenate_many(collect_words(texts), SOFT_HYPHEN) \
+        if batch else None
+    return [hyphenator.hyphenate_text(text, SOFT_HYPHEN, table)
+        for text in texts]
+
+def collect_words(texts):
+    """Yields words of all texts."""
+    for text in texts:
+        for w in WORD_RE.findall(text):
+            yield w
+
+# Seconds between checks, whether workers running jobs are still alive
+WORKER_CHECK_INTERVAL = 1.0
+
+# Queue of (job id, process id) of started jobs in a WorkerPool worker
+_started = None
+
+def _warm_worker(langs, started=None):
+    global _started
+    _started = started
+    # Ctrl-C and service managers signal the whole process group.  A worker
+    # killed while waiting for jobs holds the task queue lock, and the pool
+    # can't be terminated, so only the parent handles shutdown.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    for lang in langs:
+        get_hyphenator(lang)
+
+class WorkerDied(Exception):
+    """Worker process died while running a job, e.g. for lack of memory."""
+
+class _WorkerProcess(multiprocessing.Process):
+    def terminate(self):
+        # Workers ignore SIGTERM, see _warm_worker
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+class WorkerPool(Pool):
+    """
+    Pool of jobs worker processes, which load hyphenators for langs in
+    advance and notice jobs lost by dead workers.  Pool replaces a worker killed e.g. by the OOM killer,
+    but its job is dropped and the result never comes.  Used as a context
+    manager, the pool is closed and joined at the end of the block, or
+    terminated if the block fails or a job was lost.
+    """
+    Process = _WorkerProcess
+
+    def __init__(self, jobs, langs=()):
+        self._started_jobs = SimpleQueue()
+        self._job_pids = {}
+        self._job_lock = threading.Lock()
+        self._job_ids = count()
+        self._lost_jobs = False
+        Pool.__init__(self, jobs, _warm_worker,
+            (tuple(langs), self._started_jobs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Lost jobs never leave the pool, join after close waits for them
+        if exc_type is None and not self._lost_jobs:
+            self.close()
+        else:
+            self.terminate()
+        self.join()
+
+    def apply_tracked(self, func, args=(), callback=None):
+        """Like apply_async, but the result can be passed to lost and get."""
+        job_id = next(self._job_ids)
+        result = self.apply_async(_run_tracked, (job_id, func, args),
+            callback=callback)
+        result.job_id = job_id
+        return result
+
+    def lost(self, result):
+        """
+        Returns True if the worker running job of result has died.  Jobs
+        are forgotten once they are done or lost.
+        """
+        if result.ready():
+            self._job_pid(result.job_id, True)
+            return False
+        pid = self._job_pid(result.job_id)
+        if pid is None or _process_alive(pid):
+            return False
+        # Result sent right before the worker died is still delivered
+        result.wait(WORKER_CHECK_INTERVAL)
+        self._job_pid(result.job_id, True)
+        if result.ready():
+            return False
+        self._lost_jobs = True
+        return True
+
+    def get(self, result):
+        """
+        Waits for result of apply_tracked and returns it, raises WorkerDied
+        if the job is lost.
+        """
+        while not result.ready():
+            result.wait(WORKER_CHECK_INTERVAL)
+            if self.lost(result):
+                raise WorkerDied('worker process died while running the '
+                    'job, e.g. for lack of memory')
+        self._job_pid(result.job_id, True)
+        return result.get()
+
+    def _job_pid(self, job_id, forget=False):
+        with self._job_lock:
+            while not self._started_jobs.empty():
+                started_id, pid = self._started_jobs.get()
+                self._job_pids[started_id] = pid
+            if forget:
+                return self._job_pids.pop(job_id, None)
+            return self._job_pids.get(job_id)
+
+def _run_tracked(job_id, func, args):
+    # Written at once, so the job is known even if the worker dies now
+    _started.put((job_id, os.getpid()))
+    return func(*args)
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    # Pool reaps dead workers, so they don't stay zombies
+    return True
+
+def hyphenate_slots_parallel(slots, lang, pool, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Hyphenates texts of slots like hyphenate_slots, but in workers of pool.
+    Texts are split into chunks in document order and results are put back
+    in the same order, so the document is the same as after sequential
+    processing.
+    """
+    texts = [getattr(node, attr) for node, attr in slots]
+    bounds = [0]
+    size = 0
+    for i, text in enumerate(texts, 1):
+        size += len(text)
+        if size >= chunk_size:
+            bounds.append(i)
+            size = 0
+    if bounds[-1] < len(texts):
+        bounds.append(len(texts))
+    chunks = ((lang, texts[start:end])
+        for start, end in zip(bounds, bounds[1:]))
+    results = [pool.apply_tracked(_hyphenate_chunk, (chunk,))
+        for chunk in chunks]
+    for (start, end), result in zip(zip(bounds, bounds[1:]), results):
+        for (node, attr), text in zip(slots[start:end], pool.get(result)):
+            setattr(node, attr, text)
+
+def _hyphenate_chunk(args):
+    lang, texts = args
+    return hyphenate_texts(texts, get_hyphenator(lang))
+
 def detect_language(dom):
     nodes = dom.xpath("//*[local-name() = 'lang']")
     return nodes[0].text if nodes else False
 
-def insert_hyphens(node, hyphenator):
-    textattrs = ('text', 'tail')
-    if isinstance(node, etree._Entity):
-        # HTML entities have no .text
-        textattrs = ('tail',)
-    for attr in textattrs:
-        text = getattr(node, attr)
-        if not text:
+def book_language(source, sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Returns language of FB2 source given by its <lang> element, if there are
+    patterns for it, or detected from the first sample_size characters of
+    its texts (see sample_language).  Only the beginning of source is parsed.
+    """
+    texts = []
+    size = 0
+    for _, node in etree.iterparse(source, recover=True):
+        name = node.tag.rpartition('}')[2]
+        if name == 'lang' and normalize_language(node.text):
+            return node.text.strip()
+        if name in HYPHENATED_TAGS:
+            texts.append(u' '.join(node.itertext()))
+            size += len(texts[-1])
+            if size >= sample_size:
+                break
+            # Texts of nested elements are taken once
+            node.clear()
+    return sample_language(texts, sample_size)
+
+def sample_language(texts, sample_size=DEFAULT_SAMPLE_SIZE):
+    """
+    Returns language detected from the first sample_size characters of
+    texts, or None if it isn't detected with enough confidence.
+    """
+    sample = []
+    size = 0
+    for text in texts:
+        sample.append(text)
+        size += len(text)
+        if size >= sample_size:
+            break
+    lang, confidence = detect(u' '.join(sample)[:sample_size])
+    print('Detected language %s, confidence %.2f' % (lang, confidence))
+    return lang if confidence >= MIN_CONFIDENCE else None
+
+def text_slots(root, tags=HYPHENATED_TAGS):
+    """
+    Walks root once and yields (node, attribute) pairs of texts, which
+    should be hyphenated: text and tail of every element with local name
+    in tags and of all its descendants.  If tags is None, root itself is
+    hyphenated.
+    """
+    if tags is None:
+        targets = (root,)
+    else:
+        patterns = ['{*}%s' % tag for tag in tags]
+        targets = root.iter(*patterns)
+    # Elements from tags nested into already handled ones
+    covered = set()
+    for target in targets:
+        if target in covered:
             continue
-        if SOFT_HYPHEN in text:
-            # Don't hyphenate twice
-            print('Skipping already hyphenated text...')
+        if tags is not None:
+            covered.update(target.iter(*patterns))
+        nodes = target.iter()
+        for node in nodes:
+            textattrs = ('text', 'tail')
+            if isinstance(node, etree._Entity):
+                # HTML entities have no .text
+                textattrs = ('tail',)
+            for attr in textattrs:
+                text = getattr(node, attr)
+                if not text:
+                    continue
+                if SOFT_HYPHEN in text:
+                    # Don't hyphenate twice
+                    print('Skipping already hyphenated text...')
+                    descendants = sum(1 for _ in node.iterdescendants())
+                    next(islice(nodes, descendants, descendants), None)
+                    if tags is not None:
+                        # Nested elements from tags are processed anyway
+                        for child in node.iterchildren():
+                            for slot in text_slots(child, tags):
+                                yield slot
+                    break
+                yield node, attr
+
+def insert_hyphens(node, hyphenator, table=None):
+    """Hyphenates texts of node and all its descendants."""
+    for node, attr in text_slots(node, None):
+        setattr(node, attr, hyphenator.hyphenate_text(getattr(node, attr),
+            SOFT_HYPHEN, table))
+
+def process_fb2(input_file, output_file, stream=False, jobs=1,
+        chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Hyphenates FB2 input_file into output_file.  <binary> sections are
+    copied from input to output as they are, without parsing.  In stream
+    mode the book is processed element by element (see FB2Stream), so
+    memory use doesn't depend on the book size.  Otherwise texts are
+    hyphenated by jobs worker processes (see hyphenate_slots_parallel).
+    """
+    binaries = find_binaries(input_file)
+    with replacing(output_file) as tmp_output, \
+            open(input_file, 'rb') as f, open(tmp_output, 'wb') as output:
+        # Language is chosen before the book is parsed as a whole
+        lang = book_language(SplicedInput(f, binaries))
+        source = SplicedInput(f, binaries)
+        if binaries:
+            output = SplicedOutput(output, f, binaries, source.token)
+        if stream:
+            FB2Stream(output, lang).run(source)
+        else:
+            dom = parse_xml(source, jobs, chunk_size, lang)
+            output.write(etree.tostring(dom.getroot(), encoding='UTF-8',
+                xml_declaration=True))
+
+def process_fb2_zip(input_file, output_file, stream=False, jobs=1,
+        chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Hyphenates every FB2 book of zip archive input_file (see process_fb2)
+    and writes them into archive output_file, other entries are copied.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='kindle-hyphens-')
+    try:
+        with replacing(output_file) as tmp_output, \
+                zipfile.ZipFile(input_file) as archive, \
+                zipfile.ZipFile(tmp_output, 'w', zipfile.ZIP_DEFLATED,
+                    allowZip64=True) as output:
+            for info in archive.infolist():
+                if not info.filename.lower().endswith('.fb2'):
+                    output.writestr(info, archive.read(info))
+                    continue
+                book = os.path.join(tmp_dir, 'book.fb2')
+                with archive.open(info) as src, open(book, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                process_fb2(book, book + '.out', stream, jobs, chunk_size)
+                output.write(book + '.out', info.filename)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# Limit of hyphenated words remembered while streaming a book
+STREAM_TABLE_SIZE = 100000
+
+# Namespace declaration in serialized start tag
+_DECLARATION_RE = re.compile(br'\s+xmlns(?::([^=\s]+))?="([^"]*)"')
+
+class FB2Stream(object):
+    """
+    Incremental FB2 writer, see process_fb2.
+
+    Elements, which may still get children, are written as soon as their
+    first child starts: start tag and text.  Any other element is written
+    as a whole, together with its tail, once the next parser event shows
+    the tail is complete, and is dropped from the tree afterwards.
+    Elements from HYPHENATED_TAGS are hyphenated right before that.
+    """
+    def __init__(self, output, lang=None):
+        self.output = output
+        self.lang = lang
+        # Language of the book is known once the first text is hyphenated
+        self.started = False
+        # Hyphenated words by language
+        self.tables = {}
+        # Stack of [element, end tag or None if not written yet,
+        # namespace declarations in scope]
+        self.open = []
+        # Element from HYPHENATED_TAGS being parsed
+        self.target = None
+        # Element waiting for its tail to be written: (element, kind)
+        self.pending = None
+
+    def run(self, source):
+        self.output.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        events = etree.iterparse(source, events=('start', 'end', 'comment',
+            'pi'), recover=True)
+        for event, node in events:
+            if self.target is not None:
+                if event == 'end' and node is self.target:
+                    self.target = None
+                    self.pending = (node, 'target')
+            elif event == 'start':
+                self.start(node)
+            elif event == 'end':
+                self.end(node)
+            elif self.open:
+                # Comments and processing instructions outside of the root
+                # element are dropped, as etree.tostring(root) does.
+                self.flush()
+                self.open_parent()
+                self.pending = (node, 'element')
+        self.flush()
+
+    def start(self, node):
+        self.flush()
+        if self.open:
+            self.open_parent()
+        if node.tag.rpartition('}')[2] in HYPHENATED_TAGS:
+            self.target = node
+        else:
+            self.open.append([node, None, None])
+
+    def end(self, node):
+        self.flush()
+        _, end_tag, _ = self.open.pop()
+        if not self.started and self.lang is None and \
+                node.tag.rpartition('}')[2] == 'lang':
+            self.lang = node.text
+        if end_tag is None:
+            self.pending = (node, 'element')
+        else:
+            self.output.write(end_tag)
+            self.pending = (node, 'closed')
+
+    def open_parent(self):
+        """Writes start tag and text of the innermost open element."""
+        entry = self.open[-1]
+        if entry[1] is not None:
             return
-        new_data = ' '.join([hyphenator.hyphenate_word(w, SOFT_HYPHEN)
-            for w in text.split()])
-        # Spaces are trimmed, we have to add them manually back
-        if text[0].isspace():
-            new_data = ' ' + new_data
-        if text[-1].isspace():
-            new_data += ' '
-        setattr(node, attr, new_data)
-
-    for child in node.iterchildren():
-        insert_hyphens(child, hyphenator)
-
-def process_epub_file(container):
+        node = entry[0]
+        scope = self.open[-2][2] if len(self.open) > 1 else {}
+        # The first child has just started, so everything before it is the
+        # start tag and the text.
+        markup = etree.tostring(node, encoding='UTF-8')
+        markup, entry[2] = _strip_declarations(
+            markup[:markup.index(b'<', 1)], scope)
+        entry[1] = b'</%s>' % re.match(br'<([^\s/>]+)', markup).group(1)
+        self.output.write(markup)
+
+    def flush(self):
+        """Writes pending element, its tail is complete by now."""
+        if self.pending is None:
+            return
+        node, kind = self.pending
+        self.pending = None
+        if kind == 'closed':
+            if node.tail:
+                self.output.write(_escape(node.tail))
+        else:
+            if kind == 'target':
+                self.hyphenate(node)
+            scope = self.open[-1][2] if self.open else {}
+            markup, _ = _strip_declarations(
+                etree.tostring(node, encoding='UTF-8'), scope)
+            self.output.write(markup)
+        parent = node.getparent()
+        if parent is not None:
+            parent.remove(node)
+
+    def hyphenate(self, node):
+        if not self.started:
+            # Fallback language is Russian ;)
+            self.lang = self.lang or 'ru'
+            self.started = True
+        if sum(map(len, self.tables.values())) > STREAM_TABLE_SIZE:
+            self.tables.clear()
+        slots = list(text_slots(node))
+        # Ancestors of node are still in the tree, they may set language
+        for lang, slots in group_slots(slots,
+                slot_languages(slots, self.lang)):
+            hyphenator = get_hyphenator(lang)
+            table = self.tables.setdefault(lang, {})
+            for child, attr in slots:
+                setattr(child, attr, hyphenator.hyphenate_text(
+                    getattr(child, attr), SOFT_HYPHEN, table))
+
+def _strip_declarations(markup, scope):
+    """
+    Removes namespace declarations, which are already in scope, from the
+    first tag of markup.  Returns new markup and declarations in scope of
+    the tag.
+    """
+    name_end = re.match(br'<[^\s/>]*', markup).end()
+    scope = dict(scope)
+    kept = []
+    pos = name_end
+    match = _DECLARATION_RE.match(markup, pos)
+    while match:
+        prefix, uri = match.groups()
+        if scope.get(prefix) != uri:
+            scope[prefix] = uri
+            kept.append(match.group())
+        pos = match.end()
+        match = _DECLARATION_RE.match(markup, pos)
+    return markup[:name_end] + b''.join(kept) + markup[pos:], scope
+
+def _escape(text):
+    """Escapes text the way libxml2 serializes it."""
+    return text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(
+        u'>', u'&gt;').replace(u'\r', u'&#13;').encode('utf-8')
+
+_BINARY_RE = re.compile(br'<((?:[\w.-]+:)?binary)[\s>]')
+_NON_ASCII_RE = re.compile(br'[^\x00-\x7f]')
+_ENCODING_RE = re.compile(br'<\?xml[^>]*encoding=["\']([\w.-]+)')
+
+def find_binaries(input_file):
+    """
+    Returns list of (start, end) byte ranges of <binary> elements in FB2
+    input_file, which can be copied into UTF-8 output unparsed.
+    """
+    with open(input_file, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return []
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _find_binaries(data)
+    finally:
+        data.close()
+
+def _find_binaries(data):
+    if data[:2] in (b'\xfe\xff', b'\xff\xfe') or b'\x00' in data[:4]:
+        # UTF-16 and UTF-32 texts are not ASCII compatible
+        return []
+    encoding = _ENCODING_RE.match(data[:200])
+    # Any bytes of UTF-8 input are valid in UTF-8 output
+    utf8 = not encoding or encoding.group(1).lower() in (b'utf-8', b'utf8')
+    # Binaries are stored after all the bodies
+    pos = data.rfind(b'</body')
+    if pos < 0:
+        return []
+    binaries = []
+    match = _BINARY_RE.search(data, pos)
+    while match:
+        tag_end = data.find(b'>', match.start())
+        end = data.find(b'</%s' % match.group(1), tag_end)
+        close = data.find(b'>', end)
+        if tag_end < 0 or end < 0 or close < 0:
+            break
+        # Skip empty elements and those with markup or non-ASCII bytes
+        if data[tag_end - 1:tag_end] != b'/' and \
+                data.find(b'<', tag_end, end) < 0 and (utf8 or
+                not _NON_ASCII_RE.search(data, match.start(), close)):
+            binaries.append((match.start(), close + 1))
+            pos = close + 1
+        else:
+            pos = tag_end + 1
+        match = _BINARY_RE.search(data, pos)
+    return binaries
+
+class SplicedInput(object):
+    """
+    File-like view of file f, where given byte ranges are replaced by
+    placeholder processing instructions: <?token index?>.
+    """
+    def __init__(self, f, ranges):
+        self.f = f
+        self.token = b'kindle-hyphens-binary-' + hexlify(os.urandom(4))
+        # (placeholder or None for file data, start, end)
+        self.pieces = []
+        pos = 0
+        for i, (start, end) in enumerate(ranges):
+            self.pieces.append((None, pos, start))
+            placeholder = b'<?%s %d?>' % (self.token, i)
+            self.pieces.append((placeholder, 0, len(placeholder)))
+            pos = end
+        self.pieces.append((None, pos, None))
+        self.pieces.reverse()
+
+    def read(self, size=-1):
+        chunks = []
+        while self.pieces and size:
+            placeholder, start, end = self.pieces.pop()
+            if placeholder is None:
+                self.f.seek(start)
+                length = -1 if end is None else end - start
+                if size >= 0 and (length < 0 or size < length):
+                    length = size
+                chunk = self.f.read(length)
+            else:
+                chunk = placeholder[start:end if size < 0 else start + size]
+            start += len(chunk)
+            if chunk and (end is None or start < end):
+                self.pieces.append((placeholder, start, end))
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+class SplicedOutput(object):
+    """Copies byte ranges of file f in place of SplicedInput placeholders."""
+    def __init__(self, output, f, ranges, token):
+        self.output = output
+        self.f = f
+        self.ranges = ranges
+        self.token = token
+        self.placeholder_re = re.compile(br'<\?%s (\d+)\?>' % token)
+
+    def write(self, markup):
+        if self.token not in markup:
+            self.output.write(markup)
+            return
+        pos = 0
+        for match in self.placeholder_re.finditer(markup):
+            self.output.write(markup[pos:match.start()])
+            self.copy(*self.ranges[int(match.group(1))])
+            pos = match.end()
+        self.output.write(markup[pos:])
+
+    def copy(self, start, end):
+        self.f.seek(start)
+        while start < end:
+            block = self.f.read(min(COPY_BLOCK_SIZE, end - start))
+            self.output.write(block)
+            start += len(block)
+
+def hyphenate_fb2(data):
+    """Returns serialized FB2 document data with soft hyphens inserted."""
+    dom = parse_xml(BytesIO(data), lang=book_language(BytesIO(data)))
+    return etree.tostring(dom.getroot(), encoding='UTF-8',
+        xml_declaration=True)
+
+def hyphenate_html(html, lang):
+    """Returns serialized XHTML document html with soft hyphens inserted."""
+    dom = etree.XML(html, parser=etree.XMLParser(recover=True))
+    dom = process_dom(dom, lang)
+    return etree.tostring(dom, encoding='UTF-8', xml_declaration=True)
+
+def _html_texts(container, names):
+    for name in names:
+        dom = etree.XML(container.get_raw(name),
+            parser=etree.XMLParser(recover=True))
+        if dom is not None:
+            for body in dom.iter('{*}body'):
+                yield u' '.join(body.itertext())
+
+def process_epub_file(container, jobs=1):
+    """
+    Hyphenates all chapters of container.  Chapters are processed by jobs
+    worker processes, the biggest ones first, so a long chapter doesn't
+    keep a single worker busy after all others are done.
+    """
     if container.is_drm_encrypted():
         print('ERROR - cannot remove unused images from DRM encrypted book')
         return False
 
-    dirtied = False
-    for name in container.get_html_names():
-        html = container.get_raw(name)
-        dom = etree.XML(html, parser=etree.XMLParser(recover=True))
-
-        # Detect language
-        language = container.opf.xpath("//*[local-name() = 'language']")[0]
-        dom = process_dom(dom, language.text)
-        new_html = etree.tostring(dom, encoding='UTF-8', xml_declaration=True)
-        dirtied = True
-        container.set(name, new_html)
-    return dirtied
-
-def process_epub(input_file, output_file):
-    from calibre import CurrentDir
-    from calibre.libunzip import extract as zipextract
-    from calibre.ptempfile import TemporaryDirectory
-    from calibre.utils.logging import Log
-
-    from calibre_plugins.modify_epub.container import ExtendedContainer
-
-    input_file = os.path.abspath(input_file)
-    output_file = os.path.abspath(output_file)
-
-    # Extract the epub into a temp directory
-    with TemporaryDirectory('fb2-hyphens') as tdir:
-        with CurrentDir(tdir):
-            zipextract(input_file, tdir)
-
-            # Use our own simplified wrapper around an ePub that will
-            # preserve the file structure and css
-            container = ExtendedContainer(tdir, Log())
-            is_modified = process_epub_file(container)
-            if is_modified:
-                container.write(output_file)
+    names = list(container.get_html_names())
+    nodes = container.opf.xpath("//*[local-name() = 'language']")
+    language = nodes[0].text if nodes else None
+    if not normalize_language(language):
+        # Fallback language is Russian, like for FB2
+        language = sample_language(_html_texts(container, names)) or 'ru'
+    if jobs <= 1:
+        for name in names:
+            container.set(name, hyphenate_html(container.get_raw(name),
+                language))
+        return bool(names)
+
+    htmls = dict((name, container.get_raw(name)) for name in names)
+    order = sorted(names, key=lambda name: len(htmls[name]), reverse=True)
+    with WorkerPool(jobs, [language]) as pool:
+        results = [pool.apply_tracked(hyphenate_html, (htmls[name], language))
+            for name in order]
+        hyphenated = dict((name, pool.get(result))
+            for name, result in zip(order, results))
+    # Chapters are written in spine order
+    for name in names:
+        container.set(name, hyphenated[name])
+    return bool(names)
+
+def process_epub(input_file, output_file, jobs=1):
+    """
+    Hyphenates ePub input_file.  Raises EPubError if there is nothing to
+    write, e.g. the book is DRM encrypted.
+    """
+    with EPubContainer(input_file) as container:
+        if not process_epub_file(container, jobs):
+            raise EPubError('%s was not hyphenated' % input_file)
+        container.write(output_file)
+
+# Extensions of supported book formats
+BOOK_EXTENSIONS = ('.fb2', '.fb2.zip', '.epub')
+
+def book_format(path):
+    """Returns extension of supported book format of path, or None."""
+    for ext in BOOK_EXTENSIONS:
+        if path.lower().endswith(ext):
+            return ext
+    return None
+
+def process_book(input_file, output_file, stream=False, jobs=1,
+        chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=None,
+        cache_size=output_cache.DEFAULT_MAX_SIZE):
+    """
+    Hyphenates book input_file of any supported format.  If cache_dir is
+    given, outputs are kept there (see output_cache) and a book, which was
+    already processed, isn't parsed again.
+    """
+    ext = book_format(input_file)
+    if cache_dir:
+        # Stream mode, number of jobs and chunk size don't change output
+        key = output_cache.book_key(input_file, {'format': ext})
+        if output_cache.fetch(cache_dir, key, output_file):
+            return
+    if ext == '.fb2':
+        process_fb2(input_file, output_file, stream, jobs, chunk_size)
+    elif ext == '.fb2.zip':
+        process_fb2_zip(input_file, output_file, stream, jobs, chunk_size)
+    else:
+        process_epub(input_file, output_file, jobs)
+    if cache_dir:
+        output_cache.store(cache_dir, key, output_file, cache_size)
+
+def add_output_cache_arguments(parser):
+    """Adds output cache options to argparse parser."""
+    parser.add_argument('--output-cache', metavar='DIR',
+        default=output_cache.DEFAULT_CACHE_DIR,
+        help='directory of already hyphenated books (default: '
+        '%(default)s)')
+    parser.add_argument('--output-cache-size', metavar='MB', type=int,
+        default=output_cache.DEFAULT_MAX_SIZE >> 20,
+        help='size limit of the output cache (default: %(default)s)')
+    parser.add_argument('--no-output-cache', dest='output_cache',
+        action='store_const', const=None,
+        help="don't cache hyphenated books")
 
 if __name__ == '__main__':
-    if len(sys.argv) <= 2:
-        print( """Usage: %s input_file output_file
-        FB2 and ePub formats are supported.""" % sys.argv[0])
-        sys.exit(1)
-    input_file = sys.argv[1]
-    output_file = sys.argv[2]
-    (_, ext) = os.path.splitext(input_file.lower())
-    if ext not in ('.epub', '.fb2'):
+    parser = argparse.ArgumentParser(description=__doc__,
+        epilog='FB2 (also zipped) and ePub formats are supported.')
+    parser.add_argument('input_file')
+    parser.add_argument('output_file')
+    parser.add_argument('--stream', action='store_true',
+        help='process FB2 element by element, memory use is constant')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of worker processes hyphenating FB2 texts or ePub '
+        'chapters, 0 means one per CPU (default: 1)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+        help='characters of FB2 text sent to a worker at once (default: '
+        '%(default)s)')
+    parser.add_argument('--word-store', metavar='FILE',
+        help='SQLite database of hyphenated words shared between runs')
+    add_output_cache_arguments(parser)
+    args = parser.parse_args()
+    if args.stream and args.jobs != 1:
+        parser.error('--stream and --jobs are mutually exclusive')
+    jobs = args.jobs or multiprocessing.cpu_count()
+    input_file = args.input_file
+    output_file = args.output_file
+    if not book_format(input_file):
         print('Only ePub and FB2 formats are supported')
         sys.exit(1)
+    if args.word_store:
+        use_word_store(WordStore(args.word_store))
     print('Processing %s...' % input_file,)
     sys.stdout.flush()
-    if ext == '.fb2':
-        dom = parse_xml(input_file)
-        with codecs.open(output_file, mode='w') as f:
-            f.write(etree.tostring(dom.getroot(), encoding='UTF-8',
-                xml_declaration=True))
-    else:
-        process_epub(input_file, output_file)
+    try:
+        process_book(input_file, output_file, args.stream, jobs,
+            args.chunk_size, args.output_cache, args.output_cache_size << 20)
+    except EPubError as e:
+        print('ERROR - %s' % e)
+        sys.exit(1)
     print('Done.')
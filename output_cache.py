@@ -0,0 +1,104 @@
+#coding=utf-8
+"""
+Content-addressed cache of hyphenated books.
+
+Outputs are stored under SHA-256 digest of the input book, hyphenation
+patterns, language detection profiles and processing options, so the same
+book is processed only once: later its output is copied from the cache
+without parsing anything.  Entries are copies, not links, so editing an
+output in place never changes the cache.  Least recently used outputs are
+removed when the cache grows over its size limit.
+"""
+import hashlib
+import os
+import shutil
+
+from fileutil import replacing
+from language_detector import PROFILES_FILE
+import pattern_cache
+
+# Bump whenever processing changes output of the same book and patterns
+CACHE_VERSION = 2
+
+DEFAULT_CACHE_DIR = os.path.join(pattern_cache.DEFAULT_CACHE_DIR, 'outputs')
+DEFAULT_MAX_SIZE = 1 << 30
+
+READ_BLOCK_SIZE = 1 << 20
+
+_patterns_version = None
+
+def book_key(input_file, options):
+    """Returns cache key of book input_file processed with options dict."""
+    global _patterns_version
+    if _patterns_version is None:
+        digest = hashlib.sha1(pattern_cache.patterns_digest(
+            pattern_cache.languages()))
+        # Profiles choose the language of books, which don't name it
+        try:
+            with open(PROFILES_FILE, 'rb') as f:
+                digest.update(f.read())
+        except (IOError, OSError):
+            pass
+        _patterns_version = digest.hexdigest()
+    digest = hashlib.sha256()
+    digest.update('%d %s %r\n' % (CACHE_VERSION, _patterns_version,
+        sorted(options.items())))
+    with open(input_file, 'rb') as f:
+        for block in iter(lambda: f.read(READ_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fetch(cache_dir, key, output_file):
+    """
+    Puts output stored for key into output_file.  Returns False if there is
+    no such output.
+    """
+    path = os.path.join(cache_dir, key)
+    try:
+        # Modification time orders outputs for pruning
+        os.utime(path, None)
+        _copy(path, output_file)
+    except (IOError, OSError):
+        return False
+    return True
+
+def store(cache_dir, key, output_file, max_size=DEFAULT_MAX_SIZE):
+    """
+    Stores output_file for key and prunes the cache to max_size bytes,
+    cache write errors are ignored.
+    """
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _copy(output_file, os.path.join(cache_dir, key))
+        prune(cache_dir, max_size)
+    except (IOError, OSError):
+        pass
+
+def prune(cache_dir, max_size):
+    """Removes least recently used outputs until they fit into max_size."""
+    outputs = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.tmp'):
+            continue
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Removed by a concurrent process
+            continue
+        outputs.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in outputs)
+    for _, size, path in sorted(outputs):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def _copy(source, target):
+    # Concurrent readers of target never see it half-written
+    with replacing(target) as tmp_path:
+        shutil.copyfile(source, tmp_path)
@@ -0,0 +1,91 @@
+#coding=utf-8
+"""
+On-disk cache of compiled hyphenation patterns.
+
+Parsing pattern modules takes a noticeable part of processing a single book,
+so compiled engines are marshalled into a cache directory, one file per
+language set and engine.  Every file stores a digest of the pattern sources
+it was built from, editing a pattern module makes the cache stale and it is
+silently rebuilt.
+"""
+import hashlib
+import marshal
+import os
+import re
+import sys
+
+from fileutil import replacing
+
+# Bump whenever pattern parsing or engine state layout changes
+CACHE_VERSION = 3
+
+PATTERNS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'hyphenations')
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+    os.path.join(os.path.expanduser('~'), '.cache'), 'kindle-hyphens')
+
+
+def pattern_file(lang):
+    """Returns source file of hyphenation patterns for lang, or None."""
+    if not lang or not re.match(r'^\w+$', lang):
+        return None
+    path = os.path.join(PATTERNS_DIR, '%s.py' % lang)
+    return path if os.path.isfile(path) else None
+
+
+def languages():
+    """Returns sorted list of languages, which have hyphenation patterns."""
+    return sorted(name[:-3] for name in os.listdir(PATTERNS_DIR)
+        if name.endswith('.py') and name != '__init__.py')
+
+
+def patterns_digest(langs):
+    """Returns hex digest of the pattern sources for given languages."""
+    digest = hashlib.sha1()
+    for lang in langs:
+        digest.update(lang.encode('ascii'))
+        with open(pattern_file(lang), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _cache_path(cache_dir, langs, engine):
+    # Marshal format is specific to Python version
+    return os.path.join(cache_dir, '%s.%s.py%d%d.cache' %
+        ('+'.join(langs), engine, sys.version_info[0], sys.version_info[1]))
+
+
+def load(cache_dir, langs, engine):
+    """
+    Returns (engine name, engine state, exceptions, alphabet) stored for
+    given languages and requested engine name, or None if there is no valid
+    cache entry.  Engine names differ when 'auto' engine was requested.
+    """
+    try:
+        with open(_cache_path(cache_dir, langs, engine), 'rb') as f:
+            data = f.read()
+        version, digest, name, state, exceptions, alphabet = \
+            marshal.loads(data)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != CACHE_VERSION or digest != patterns_digest(langs):
+        return None
+    return name, state, exceptions, alphabet
+
+
+def save(cache_dir, langs, engine, name, state, exceptions, alphabet):
+    """
+    Stores state of compiled engine called name for requested engine, cache
+    write errors are ignored.
+    """
+    path = _cache_path(cache_dir, langs, engine)
+    data = marshal.dumps((CACHE_VERSION, patterns_digest(langs), name, state,
+        exceptions, alphabet))
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Atomic, so concurrent workers never see half-written files
+        with replacing(path) as tmp_path, open(tmp_path, 'wb') as f:
+            f.write(data)
+    except (IOError, OSError):
+        pass
@@ -0,0 +1,167 @@
+#!/usr/bin/env python2.7
+"""
+Hyphenation server, which accepts jobs over a Unix domain socket.
+
+Worker processes load hyphenators for all languages once, so jobs don't pay
+for process startup and patterns loading.  Use client.py to send jobs from
+shell.
+
+Every request and reply is a JSON header line followed by a payload of
+header['length'] bytes.  Requests are:
+
+    {"job": "files", "input": path, "output": path, "stream": false}
+    {"job": "fb2", "length": n}
+    {"job": "xhtml", "lang": "en", "length": n}
+
+Reply is {"status": "ok", "length": n} with hyphenated document as payload
+(empty for files job), or {"status": "error", "message": text}.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import threading
+
+from client import DEFAULT_SOCKET, MAX_HEADER_SIZE, ServerError
+from hyphenator import use_word_store
+from main import WorkerPool, hyphenate_fb2, hyphenate_html, process_book
+import pattern_cache
+from word_store import WordStore
+
+# Connections handled at once, further ones wait in the listen queue
+DEFAULT_MAX_PENDING = 64
+
+# Workers are terminated on shutdown, so they write new words after each job
+_word_store = None
+
+def run_job(header, payload):
+    """Runs job described by request header in a worker process."""
+    try:
+        return _run_job(header, payload)
+    except Exception as e:
+        # Pool fails to pass some exceptions, like lxml ones, back
+        raise ServerError(_error_message(e))
+    finally:
+        if _word_store is not None:
+            _word_store.flush()
+
+def _run_job(header, payload):
+    job = header.get('job')
+    if job == 'files':
+        process_book(header['input'], header['output'],
+            header.get('stream', False))
+        return b''
+    if job == 'fb2':
+        return hyphenate_fb2(payload)
+    if job == 'xhtml':
+        # Fallback language is Russian, like for FB2
+        return hyphenate_html(payload, header.get('lang') or 'ru')
+    raise ValueError('Unknown job %r' % job)
+
+def _error_message(e):
+    return '%s: %s' % (type(e).__name__, e)
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline(MAX_HEADER_SIZE)
+        if not line:
+            # Connected just to check whether the server is running
+            return
+        try:
+            header = json.loads(line)
+            payload = self.rfile.read(header.get('length', 0))
+            pool = self.server.pool
+            # A dead worker fails its job, so the connection is released
+            result = pool.get(pool.apply_tracked(run_job, (header, payload)))
+        except ServerError as e:
+            self.reply({'status': 'error', 'message': str(e)})
+        except Exception as e:
+            self.reply({'status': 'error', 'message': _error_message(e)})
+        else:
+            self.reply({'status': 'ok', 'length': len(result)}, result)
+
+    def reply(self, header, payload=b''):
+        self.wfile.write(json.dumps(header) + '\n')
+        self.wfile.write(payload)
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Serves every connection in a thread, which waits for a pool worker.
+    At most max_pending connections are accepted at once, so clients are
+    slowed down instead of piling up jobs in memory.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, jobs, max_pending=DEFAULT_MAX_PENDING):
+        # Workers are forked before any threads are started
+        self.pool = WorkerPool(jobs, pattern_cache.languages())
+        self.pending = threading.BoundedSemaphore(max_pending)
+        SocketServer.UnixStreamServer.__init__(self, path, RequestHandler)
+
+    def process_request(self, request, client_address):
+        self.pending.acquire()
+        SocketServer.ThreadingMixIn.process_request(self, request,
+            client_address)
+
+    def shutdown_request(self, request):
+        try:
+            SocketServer.UnixStreamServer.shutdown_request(self, request)
+        finally:
+            self.pending.release()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        os.remove(self.server_address)
+        self.pool.terminate()
+        self.pool.join()
+
+def remove_stale_socket(path):
+    """Removes socket file left by a killed server, if any."""
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        os.remove(path)
+    else:
+        raise ServerError('Server is already running on %s' % path)
+    finally:
+        sock.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--socket', default=DEFAULT_SOCKET,
+        help='path of Unix socket (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+        help='number of worker processes, 0 means one per CPU (default: 0)')
+    parser.add_argument('--max-pending', type=int,
+        default=DEFAULT_MAX_PENDING,
+        help='number of connections handled at once (default: %(default)s)')
+    parser.add_argument('--word-store', metavar='FILE',
+        help='SQLite database of hyphenated words shared between runs')
+    args = parser.parse_args()
+    try:
+        remove_stale_socket(args.socket)
+    except ServerError as e:
+        parser.exit(1, 'ERROR - %s\n' % e)
+    if args.word_store:
+        _word_store = WordStore(args.word_store)
+        use_word_store(_word_store)
+    server = Server(args.socket, args.jobs or multiprocessing.cpu_count(),
+        args.max_pending)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    print('Listening on %s...' % args.socket)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
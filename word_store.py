@@ -0,0 +1,191 @@
+#coding=utf-8
+"""
+Persistent store of word break positions, shared between runs and worker
+processes.
+
+Words are kept in an SQLite database together with the pattern set they
+were hyphenated with, so editing patterns never returns stale positions.
+Writes and use counts are buffered and written in batches, and the least
+used words are evicted when the store grows over its limit.
+
+Run this module with a language code and text files as arguments to see
+how much pattern matching the store saves on a second pass.
+"""
+import os
+import sqlite3
+import threading
+from multiprocessing import util
+
+DEFAULT_MAX_ENTRIES = 1000000
+DEFAULT_BATCH_SIZE = 5000
+
+# Words looked up by a single query, within SQLite limit of parameters
+PREFETCH_SIZE = 500
+
+class WordStore(object):
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES,
+            batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        # New positions and use counts, which aren't written yet
+        self.pending = {}
+        self.uses = {}
+        # Positions of words read in advance by prefetch
+        self.loaded_patterns = None
+        self.loaded = {}
+
+    def _connect(self):
+        if self.pid != os.getpid():
+            # Connections and buffers are not shared with forked processes
+            self.connection = sqlite3.connect(self.path, timeout=60,
+                check_same_thread=False)
+            # Readers don't wait for writers
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS words ('
+                    'patterns TEXT, word TEXT, positions TEXT, uses INTEGER, '
+                    'PRIMARY KEY (patterns, word))')
+            self.pending = {}
+            self.uses = {}
+            self.loaded_patterns = None
+            self.loaded = {}
+            self.pid = os.getpid()
+            # Runs at exit of pool workers too, unlike atexit
+            util.Finalize(self, self.flush, exitpriority=10)
+        return self.connection
+
+    def get(self, patterns, word):
+        """
+        Returns tuple of break positions of lowercase word hyphenated with
+        patterns (a pattern set version), or None if it isn't stored.
+        """
+        with self.lock:
+            connection = self._connect()
+            key = (patterns, word)
+            positions = self.pending.get(key)
+            if positions is not None:
+                return positions
+            if patterns == self.loaded_patterns and word in self.loaded:
+                # Use is already counted by prefetch, missing words are None
+                return self.loaded[word]
+            row = connection.execute('SELECT positions FROM words '
+                'WHERE patterns = ? AND word = ?', key).fetchone()
+            if row is None:
+                return None
+            positions = _decode(row[0])
+            self.uses[key] = self.uses.get(key, 0) + 1
+            if len(self.uses) >= self.batch_size:
+                self._flush()
+            return positions
+
+    def prefetch(self, patterns, words):
+        """
+        Reads positions of many words, e.g. vocabulary of a book, at once.
+        Later get calls for them don't query the database, and each of them
+        is counted as used once.  Replaces previously prefetched words.
+        """
+        words = list(words)
+        with self.lock:
+            connection = self._connect()
+            self.loaded_patterns = patterns
+            self.loaded = loaded = dict.fromkeys(words)
+            with connection:
+                for start in range(0, len(words), PREFETCH_SIZE):
+                    chunk = words[start:start + PREFETCH_SIZE]
+                    where = 'WHERE patterns = ? AND word IN (%s)' % \
+                        ','.join('?' * len(chunk))
+                    params = [patterns] + chunk
+                    for word, positions in connection.execute(
+                            'SELECT word, positions FROM words ' + where,
+                            params):
+                        loaded[word] = _decode(positions)
+                    connection.execute(
+                        'UPDATE words SET uses = uses + 1 ' + where, params)
+
+    def release(self):
+        """Drops prefetched positions."""
+        with self.lock:
+            self.loaded_patterns = None
+            self.loaded = {}
+
+    def put(self, patterns, word, positions):
+        with self.lock:
+            self._connect()
+            self.pending[(patterns, word)] = positions
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        """Writes buffered positions and use counts."""
+        with self.lock:
+            if self.pid == os.getpid():
+                self._flush()
+
+    def _flush(self):
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO words '
+                'VALUES (?, ?, ?, 1)', [(patterns, word, _encode(positions))
+                for (patterns, word), positions in self.pending.items()])
+            self.connection.executemany('UPDATE words SET uses = uses + ? '
+                'WHERE patterns = ? AND word = ?', [(uses, patterns, word)
+                for (patterns, word), uses in self.uses.items()])
+            if self.pending:
+                self._evict()
+        self.pending.clear()
+        self.uses.clear()
+
+    def _evict(self):
+        count = self.connection.execute(
+            'SELECT COUNT(*) FROM words').fetchone()[0]
+        if count > self.max_entries:
+            # Leave some room, so eviction doesn't run on every write
+            self.connection.execute('DELETE FROM words WHERE rowid IN '
+                '(SELECT rowid FROM words ORDER BY uses LIMIT ?)',
+                (count - self.max_entries * 9 // 10,))
+
+    def __len__(self):
+        self.flush()
+        with self.lock:
+            return self._connect().execute(
+                'SELECT COUNT(*) FROM words').fetchone()[0]
+
+def _encode(positions):
+    return ','.join(map(str, positions))
+
+def _decode(text):
+    return tuple(map(int, text.split(','))) if text else ()
+
+if __name__ == '__main__':
+    import io
+    import sys
+    import tempfile
+    from timeit import default_timer
+
+    from hyphenator import WORD_RE, Hyphenator
+
+    lang = sys.argv[1]
+    text = u''.join(io.open(path, encoding='utf-8', errors='replace').read()
+        for path in sys.argv[2:])
+    path = os.path.join(tempfile.mkdtemp(), 'words.sqlite')
+    store = WordStore(path)
+    for run in (1, 2):
+        # Fresh hyphenator, like in a new process
+        hyphenator = Hyphenator(lang, word_store=store, word_table=False)
+        calls = [0]
+        for patterns in hyphenator.scripts.values():
+            def counted(work, points=patterns.engine.points):
+                calls[0] += 1
+                return points(work)
+            patterns.engine.points = counted
+        start = default_timer()
+        # Like main.process_dom does in batch mode
+        table = hyphenator.hyphenate_many(WORD_RE.findall(text))
+        hyphenator.hyphenate_text(text, words=table)
+        store.flush()
+        print('pass %d\t%6.3f s\t%d pattern matches\t%d stored words' % (
+            run, default_timer() - start, calls[0], len(store)))
+    os.remove(path)
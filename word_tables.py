@@ -0,0 +1,187 @@
+#!/usr/bin/env python2.7
+#coding=utf-8
+"""
+Precomputed tables of the most frequent words and their break positions.
+
+A table is shipped next to pattern module of every language, e.g.
+hyphenations/ru.words, and is looked up by Hyphenator before pattern
+matching.  Tables record the patterns they were generated with, a table
+made stale by pattern changes is ignored until it's regenerated.
+
+Run this module with a language code and plain text files to generate a
+table from word frequencies of the texts, or from frequency lists with
+--frequency-list.  --check compares shipped tables with the patterns and
+--update regenerates stale ones from their own words.
+"""
+from __future__ import print_function
+import argparse
+from collections import Counter
+import io
+import os
+import sys
+
+from fileutil import replacing
+import pattern_cache
+
+DEFAULT_SIZE = 20000
+
+def table_file(lang):
+    """Returns file of the word table for lang, which may not exist."""
+    return os.path.join(pattern_cache.PATTERNS_DIR, '%s.words' % lang)
+
+def _version(langs):
+    # Changes with pattern sources and with the way they are parsed
+    return '%s %d %s' % ('+'.join(langs), pattern_cache.CACHE_VERSION,
+        pattern_cache.patterns_digest(langs))
+
+def read(lang):
+    """
+    Returns (version, comments, hyphenated words) of the table for lang, or
+    None if there is no table.
+    """
+    try:
+        with io.open(table_file(lang), encoding='utf-8') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    version = None
+    comments = []
+    # Comments are followed by hyphenated words, one per line
+    while data.startswith(u'#'):
+        line, _, data = data.partition(u'\n')
+        if line.startswith(u'# patterns '):
+            version = line[len(u'# patterns '):].strip()
+        else:
+            comments.append(line[1:].strip())
+    return version, comments, data.split()
+
+def load(lang, langs):
+    """
+    Returns dict mapping lowercase words to the words hyphenated with '-'
+    (see positions) from the table for lang, or None if there is no table
+    generated with patterns for langs.
+    """
+    table = read(lang)
+    if table is None or table[0] != _version(langs):
+        return None
+    # Positions are computed on lookup, it makes loading several times faster
+    return dict((word.replace(u'-', u''), word) for word in table[2])
+
+def positions(hyphenated):
+    """Returns tuple of break positions of a word hyphenated with '-'."""
+    breaks = []
+    end = 0
+    for piece in hyphenated.split(u'-')[:-1]:
+        end += len(piece)
+        breaks.append(end)
+    return tuple(breaks)
+
+def frequent_words(files, frequency_list=False):
+    """
+    Returns lowercase words of files, the most frequent first.  Every line
+    of a frequency list starts with a word, lines are already sorted.
+    """
+    from hyphenator import WORD_RE
+
+    counts = Counter()
+    listed = []
+    for path in files:
+        with io.open(path, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if frequency_list:
+                    fields = line.split()
+                    if fields:
+                        listed.append(fields[0].lower())
+                else:
+                    counts.update(word.lower()
+                        for word in WORD_RE.findall(line))
+    words = listed + [word for word, _ in counts.most_common()]
+    seen = set()
+    # Short words and words broken by non-letters aren't hyphenated as whole
+    return [word for word in words if len(word) > 3 and word.isalpha() and
+        not (word in seen or seen.add(word))]
+
+def generate(lang, words, size=DEFAULT_SIZE, comments=()):
+    """
+    Writes table for lang of the first size words, hyphenated with the
+    current patterns.  Returns number of written words.
+    """
+    from hyphenator import Hyphenator, resolve_languages
+
+    langs = resolve_languages(lang)
+    hyphenator = Hyphenator(lang, word_table=False, word_cache_size=0)
+    words = words[:size]
+    path = table_file(lang)
+    with replacing(path) as tmp_path, \
+            io.open(tmp_path, 'w', encoding='utf-8') as f:
+        for comment in comments:
+            f.write(u'# %s\n' % comment)
+        f.write(u'# patterns %s\n' % _version(langs))
+        for word in words:
+            f.write(hyphenator.hyphenate_word(word) + u'\n')
+    return len(words)
+
+def check(lang):
+    """
+    Returns list of problems of the table for lang: whether it matches the
+    patterns and every word is broken exactly like the patterns do.
+    """
+    from hyphenator import Hyphenator, resolve_languages
+
+    langs = resolve_languages(lang)
+    table = load(lang, langs)
+    if table is None:
+        return ['%s: no table generated with current %s patterns' %
+            (lang, '+'.join(langs))]
+    hyphenator = Hyphenator(lang, word_table=False, word_cache_size=0)
+    return ['%s: table breaks %s, patterns give %s' % (lang,
+        hyphenated.encode('utf-8'),
+        hyphenator.hyphenate_word(word).encode('utf-8'))
+        for word, hyphenated in sorted(table.items())
+        if hyphenator.hyphen_positions(word) != positions(hyphenated)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('lang', nargs='?')
+    parser.add_argument('files', nargs='*', metavar='file')
+    parser.add_argument('-n', '--size', type=int, default=DEFAULT_SIZE,
+        help='number of words in the table (default: %(default)s)')
+    parser.add_argument('--frequency-list', action='store_true',
+        help='files list words, the most frequent first')
+    parser.add_argument('--comment', action='append', default=[],
+        help='line written at the top of the table, e.g. source of words')
+    parser.add_argument('--check', action='store_true',
+        help='check tables of all languages against their patterns')
+    parser.add_argument('--update', action='store_true',
+        help='regenerate tables of all languages, which fail the check')
+    args = parser.parse_args()
+
+    langs = [lang for lang in pattern_cache.languages()
+        if os.path.exists(table_file(lang))]
+    if args.check or args.update:
+        failed = False
+        for lang in langs:
+            problems = check(lang)
+            if problems and args.update:
+                _, comments, words = read(lang)
+                generate(lang, [word.replace(u'-', u'') for word in words],
+                    len(words), comments)
+                problems = check(lang)
+                print('%s: updated' % lang)
+            for problem in problems:
+                print(problem)
+            failed = failed or bool(problems)
+        sys.exit(1 if failed else 0)
+
+    if not args.lang or not args.files:
+        parser.error('language and files are required')
+    count = generate(args.lang,
+        frequent_words(args.files, args.frequency_list), args.size,
+        args.comment)
+    problems = check(args.lang)
+    for problem in problems:
+        print(problem)
+    print('%s: %d words written to %s' % (args.lang, count,
+        table_file(args.lang)))
+    sys.exit(1 if problems else 0)